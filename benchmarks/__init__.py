@@ -0,0 +1,5 @@
+# Benchmarks for the tutoring scripts. Run them from the project folder, for example:
+# python -m benchmarks.parser
+# python -m benchmarks.backfill --count 6000
+# python -m benchmarks.pipeline --sizes 100 10000
+# python -m benchmarks.templates --count 10000
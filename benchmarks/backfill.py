@@ -0,0 +1,62 @@
+"""
+Backfills a label of synthetic emails from the fake IMAP server over several connections with
+a parse cache too small to hold them all, and fails if any event is lost or out of order
+compared to reading the label over one connection with a cache big enough for everything.
+Every other email is backfilled first, like a sync state that was lost after an earlier run,
+so each range mixes emails that are cached with ones that are not.
+
+    python -m benchmarks.backfill --count 6000 --max-entries 6000 --connections 4
+"""
+import argparse
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+from main import Gmail, ParseCache
+from benchmarks.corpus import corpus
+from benchmarks.fakes import FakeIMAPServer
+
+
+def run(name: str, work) -> list:
+    start = perf_counter()
+    events = [(event.invitee, event.date, event.time) for event in work()]
+    print(f'{name:>12}: {perf_counter() - start:.2f}s, {len(events):,} events')
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=6000, help='How many emails are in the label.')
+    parser.add_argument('--max-entries', type=int, default=6000,
+                        help='Size of the parse cache, each email takes up to two entries.')
+    parser.add_argument('--connections', type=int, default=4, help='IMAP connections the backfill uses.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the IMAP server waits per command.')
+    args = parser.parse_args()
+    if args.count <= args.max_entries // 2:
+        print(f'Warning: {args.count:,} emails fit in a cache of {args.max_entries:,} entries, nothing is evicted.')
+
+    with tempfile.TemporaryDirectory() as folder, FakeIMAPServer(corpus(args.count), args.latency) as imap:
+        gmail = Gmail('tutor', 'password', '127.0.0.1', imap.port, ssl=False)
+        gmail.set_label('Tutoring')
+        uids = gmail.search_uids()
+
+        expected = run('one', lambda: gmail.iter_events(
+            ParseCache(os.path.join(folder, 'expected.json'), args.count * 2), sender='calendly.com', uids=uids))
+        cache = ParseCache(os.path.join(folder, 'parse_cache.json'), args.max_entries)
+        run('every other', lambda: (event for _, events in gmail.backfill(
+            cache, uids[::2], args.connections, sender='calendly.com') for event in events))
+        backfilled = run('backfill', lambda: (event for _, events in gmail.backfill(
+            cache, uids, args.connections, sender='calendly.com') for event in events))
+        gmail.connection.logout()
+
+    print(f'{len(cache.entries):,} of {args.max_entries:,} cache entries used.')
+    if backfilled != expected:
+        lost = len(set(expected) - set(backfilled))
+        print(f'The backfill lost {lost:,} events or returned them out of order!')
+        sys.exit(1)
+    print('Every event was returned in order.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import datetime
+import random
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+FIRST_NAMES = ['Ava', 'Ben', 'Carla', 'Dmitri', 'Elena', 'Farah', 'Gus', 'Hana', 'Ivan', 'Jules', 'Kofi', 'Lena']
+LAST_NAMES = ['Nguyen', 'Smith', 'Okafor', 'Garcia', 'Kowalski', 'Haddad', 'Ito', 'Moreau', 'Silva', 'Brown']
+TIMEZONES = ['Pacific Time - US & Canada', 'Mountain Time - US & Canada', 'Central Time - US & Canada',
+             'Eastern Time - US & Canada']
+
+PLAIN = '''Hi Tutor,
+
+A new event has been scheduled.
+
+Event Type:
+Cybersecurity Boot Camp - Tutorial
+
+Invitee:
+{name}
+
+Invitee Email:
+{email}
+
+Event Date/Time:
+{clock} - {weekday}, {day} {month} {year} (Pacific Time - US & Canada)
+
+Invitee Time Zone:
+{timezone}
+
+Questions:
+What would you like to work on?
+
+• Going over this week’s homework on {topic}, the lab didn’t work for me.
+
+View event in Calendly
+
+Pro Tip! Take Calendly on the go. Download the Calendly iOS app or Android app.
+'''
+
+HTML = '''<html><head><style>td {{ font-family: Helvetica, Arial; }}</style></head><body>
+<table><tr><td><p>Hi Tutor,</p><p>A new event has been scheduled.</p>
+<p><b>Event Type:</b><br>Cybersecurity Boot Camp - Tutorial</p>
+<p><b>Invitee:</b><br>{name}</p>
+<p><b>Invitee Email:</b><br><a href="mailto:{email}">{email}</a></p>
+<p><b>Event Date/Time:</b><br>{clock} - {weekday}, {day} {month} {year} (Pacific Time - US &amp; Canada)</p>
+<p><b>Invitee Time Zone:</b><br>{timezone}</p>
+<p><b>Questions:</b><br>What would you like to work on?</p>
+<p>&#8226; Going over this week&#8217;s homework on {topic}, the lab didn&#8217;t work for me.</p>
+<p><a href="https://calendly.com/app/scheduled_events/user/me">View event in Calendly</a></p>
+</td></tr></table></body></html>
+'''
+
+TOPICS = ['SQL injection', 'Wireshark', 'Linux permissions', 'Nmap scans', 'Python scripting', 'firewalls']
+
+
+def calendly_message(number: int, rng: random.Random, today: datetime.date = None) -> bytes:
+    """
+    This function builds one Calendly 'New Event' notification the same way Calendly sends
+    them, a multipart email with a quoted-printable text part and an HTML part.
+    :param number:
+    :param rng:
+    :param today:
+    :return:
+    """
+    today = today or datetime.date.today()
+    when = datetime.datetime.combine(today + datetime.timedelta(days=rng.randint(-30, 30)),
+                                     datetime.time(rng.randint(8, 20), rng.choice([0, 30])))
+    name = f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {number}'
+    fields = {'name': name,
+              'email': name.lower().replace(' ', '.') + '@example.com',
+              'clock': when.strftime('%I:%M%p').lower(),
+              'weekday': when.strftime('%A'),
+              'day': when.day,
+              'month': when.strftime('%B'),
+              'year': when.year,
+              'timezone': rng.choice(TIMEZONES),
+              'topic': rng.choice(TOPICS)}
+    msg = EmailMessage()
+    msg['From'] = 'Calendly <notifications@calendly.com>'
+    msg['To'] = 'tutor@example.com'
+    msg['Subject'] = f'New Event: {name} - {fields["clock"]} {when:%a, %b %d, %Y} - Tutorial'
+    msg['Date'] = format_datetime(datetime.datetime(2021, 9, 1, 12, 0) + datetime.timedelta(minutes=number))
+    msg['Message-ID'] = f'<calendly-{number}@calendly.com>'
+    msg.set_content(PLAIN.format(**fields), cte='quoted-printable')
+    msg.add_alternative(HTML.format(**fields), subtype='html', cte='quoted-printable')
+    return msg.as_bytes().replace(b'\n', b'\r\n')
+
+
+def other_message(number: int, rng: random.Random) -> bytes:
+    """
+    This function builds an email that ended up in the label but is not from Calendly.
+    :param number:
+    :param rng:
+    :return:
+    """
+    msg = EmailMessage()
+    msg['From'] = f'{rng.choice(FIRST_NAMES)} <student{number}@example.com>'
+    msg['To'] = 'tutor@example.com'
+    msg['Subject'] = f'Re: Tutoring question {number}'
+    msg['Date'] = format_datetime(datetime.datetime(2021, 9, 1, 12, 0) + datetime.timedelta(minutes=number))
+    msg['Message-ID'] = f'<student-{number}@example.com>'
+    msg.set_content(f'Hi!\n\nThanks for the session, the notes on {rng.choice(TOPICS)} really helped.\n' * 5)
+    return msg.as_bytes().replace(b'\n', b'\r\n')
+
+
+def corpus(count: int, calendly_share: float = 0.8, seed: int = 1) -> list:
+    """
+    This function returns a list of raw emails where roughly calendly_share of them are
+    Calendly notifications and the rest are ordinary mail.
+    :param count:
+    :param calendly_share:
+    :param seed:
+    :return:
+    """
+    rng = random.Random(seed)
+    return [calendly_message(i, rng) if rng.random() < calendly_share else other_message(i, rng)
+            for i in range(count)]
@@ -0,0 +1,315 @@
+"""
+Local stand-ins for the services the scripts talk to so a whole run can be measured offline:
+an IMAP server holding a list of emails, an SMTP server that accepts and throws away mail,
+and an HTTP server answering the Zoom and Google Calendar requests. Each one can wait a
+fixed number of seconds before answering to act like a server far away.
+"""
+import base64
+import itertools
+import json
+import re
+import socketserver
+import threading
+from email.parser import BytesHeaderParser, BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+
+# Finds the UID range of a 'UID SEARCH UID 5:*' command.
+SEARCH_RANGE = re.compile(rb'UID (\d+):(\d+|\*)', re.I)
+
+
+def parse_message_set(text: bytes, largest: int) -> list:
+    """
+    This function turns an IMAP message set such as b'1:4,7,9:*' into a list of numbers.
+    :param text:
+    :param largest:
+    :return:
+    """
+    numbers = []
+    for part in text.split(b','):
+        first, _, last = part.partition(b':')
+        first = largest if first == b'*' else int(first)
+        last = first if not last else largest if last == b'*' else int(last)
+        numbers.extend(range(min(first, last), max(first, last) + 1))
+    return numbers
+
+
+class Server:
+
+    def __init__(self, server):
+        """
+        This is what every fake server shares, it runs the server in the background from
+        start until stop and can be used in a with statement.
+        :param server:
+        """
+        self.server = server
+        self.server.daemon_threads = True
+        self.port = server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class FakeIMAPServer(Server):
+
+    def __init__(self, messages: list, latency: float = 0, uidvalidity: int = 1):
+        """
+        This IMAP server has one mailbox holding the messages provided, the first has UID 1.
+        It understands the commands the Gmail class sends and nothing more.
+        :param messages:
+        :param latency:
+        :param uidvalidity:
+        """
+        self.messages = messages
+        self.latency = latency
+        self.uidvalidity = uidvalidity
+        self.headers = {}
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                fake.session(self.rfile, self.wfile)
+
+        super().__init__(socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler))
+
+    def header(self, uid: int) -> bytes:
+        """
+        This function returns the From, Subject and Date headers of a message the way a
+        BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)] fetch does.
+        :param uid:
+        :return:
+        """
+        if uid not in self.headers:
+            parsed = BytesHeaderParser().parsebytes(self.messages[uid - 1])
+            self.headers[uid] = ''.join(f'{name}: {parsed[name]}\r\n' for name in ('From', 'Subject', 'Date')
+                                        if parsed[name]).encode() + b'\r\n'
+        return self.headers[uid]
+
+    def session(self, rfile, wfile) -> None:
+        """
+        This function talks to one client until it logs out. This should not be run alone.
+        :param rfile:
+        :param wfile:
+        :return:
+        """
+        wfile.write(b'* OK [CAPABILITY IMAP4rev1 IDLE] Fake IMAP ready\r\n')
+        for line in iter(rfile.readline, b''):
+            tag, _, rest = line.rstrip(b'\r\n').partition(b' ')
+            command, _, args = rest.partition(b' ')
+            command = command.upper()
+            if command == b'UID':
+                command, _, args = args.partition(b' ')
+                command = b'UID ' + command.upper()
+            if self.latency:
+                sleep(self.latency)
+            if command == b'CAPABILITY':
+                wfile.write(b'* CAPABILITY IMAP4rev1 IDLE\r\n')
+            elif command in (b'SELECT', b'EXAMINE'):
+                wfile.write(b'* %d EXISTS\r\n* 0 RECENT\r\n* OK [UIDVALIDITY %d] UIDs valid\r\n'
+                            b'* OK [UIDNEXT %d] Predicted next UID\r\n'
+                            % (len(self.messages), self.uidvalidity, len(self.messages) + 1))
+            elif command == b'UID SEARCH':
+                found = SEARCH_RANGE.search(args)
+                first = int(found.group(1)) if found else 1
+                last = len(self.messages) if not found or found.group(2) == b'*' else int(found.group(2))
+                uids = range(max(first, 1), min(last, len(self.messages)) + 1)
+                # Like a real server a range ending in '*' always includes the newest message.
+                if not uids and self.messages and found and found.group(2) == b'*':
+                    uids = [len(self.messages)]
+                wfile.write(b'* SEARCH' + b''.join(b' %d' % uid for uid in uids) + b'\r\n')
+            elif command == b'UID FETCH':
+                numbers, _, items = args.partition(b' ')
+                headers_only = b'HEADER.FIELDS' in items.upper()
+                for uid in parse_message_set(numbers, len(self.messages)):
+                    if not 1 <= uid <= len(self.messages):
+                        continue
+                    if headers_only:
+                        data, name = self.header(uid), b'BODY[HEADER.FIELDS (FROM SUBJECT DATE)]'
+                    else:
+                        data, name = self.messages[uid - 1], b'RFC822'
+                    wfile.write(b'* %d FETCH (UID %d %s {%d}\r\n' % (uid, uid, name, len(data)) + data + b')\r\n')
+            elif command == b'LOGOUT':
+                wfile.write(b'* BYE Fake IMAP logging out\r\n' + tag + b' OK LOGOUT completed\r\n')
+                wfile.flush()
+                return
+            elif command not in (b'LOGIN', b'NOOP'):
+                wfile.write(tag + b' BAD Not supported by the fake server\r\n')
+                wfile.flush()
+                continue
+            wfile.write(tag + b' OK ' + command + b' completed\r\n')
+            wfile.flush()
+
+
+class SMTPSink(Server):
+
+    def __init__(self, latency: float = 0):
+        """
+        This SMTP server accepts any login and any message and only counts them.
+        :param latency:
+        """
+        self.latency = latency
+        self.received = 0
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                fake.session(self.rfile, self.wfile)
+
+        super().__init__(socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler))
+
+    def session(self, rfile, wfile) -> None:
+        """
+        This function talks to one client until it quits. This should not be run alone.
+        :param rfile:
+        :param wfile:
+        :return:
+        """
+        wfile.write(b'220 sink ESMTP ready\r\n')
+        wfile.flush()
+        for line in iter(rfile.readline, b''):
+            command = line[:4].upper()
+            if command == b'EHLO':
+                reply = b'250-sink\r\n250-AUTH PLAIN LOGIN\r\n250 SIZE 35882577'
+            elif command == b'HELO':
+                reply = b'250 sink'
+            elif command == b'AUTH':
+                # PLAIN may send the credentials on the same line, LOGIN asks for each one.
+                words = line.split()
+                prompts = 2 if words[1].upper() == b'LOGIN' else 0 if len(words) > 2 else 1
+                for _ in range(prompts):
+                    wfile.write(b'334 ' + base64.b64encode(b'Continue') + b'\r\n')
+                    wfile.flush()
+                    rfile.readline()
+                reply = b'235 Authentication successful'
+            elif command == b'DATA':
+                wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                wfile.flush()
+                size = sum(len(data) for data in iter(rfile.readline, b'.\r\n'))
+                if self.latency:
+                    sleep(self.latency)
+                with self.lock:
+                    self.received += 1
+                    self.bytes_received += size
+                reply = b'250 Queued'
+            elif command == b'QUIT':
+                wfile.write(b'221 Bye\r\n')
+                wfile.flush()
+                return
+            else:
+                reply = b'250 OK'
+            wfile.write(reply + b'\r\n')
+            wfile.flush()
+
+
+class StubAPI(Server):
+
+    def __init__(self, latency: float = 0):
+        """
+        This HTTP server answers the Zoom 'create meeting' request at /v2 and the Google
+        Calendar 'insert event' request at /calendar/v3, alone or in a batch at /batch. It
+        counts the requests it gets.
+        :param latency:
+        """
+        self.latency = latency
+        self.requests = {'zoom': 0, 'calendar': 0}
+        self.ids = itertools.count(85000000000)
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keeping connections open like the real APIs do.
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path.startswith('/batch/'):
+                    content_type, data = fake.answer_batch(self.headers['Content-Type'], body)
+                    status = 200
+                else:
+                    status, reply = fake.answer(self.path, body)
+                    content_type, data = 'application/json', json.dumps(reply).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(ThreadingHTTPServer(('127.0.0.1', 0), Handler))
+        self.url = f'http://127.0.0.1:{self.port}'
+
+    def answer(self, path: str, body: bytes, wait: bool = True) -> tuple:
+        """
+        This function returns the (status, json reply) for a request. This should not be run alone.
+        :param path:
+        :param body:
+        :param wait:
+        :return:
+        """
+        if self.latency and wait:
+            sleep(self.latency)
+        with self.lock:
+            number = next(self.ids)
+            if path.startswith('/v2/users/me/meetings'):
+                self.requests['zoom'] += 1
+                return 201, {'id': number, 'join_url': f'https://us02web.zoom.us/j/{number}', 'password': 'x7Kq2p'}
+            if path.startswith('/calendar/v3/calendars/'):
+                self.requests['calendar'] += 1
+                return 200, dict(json.loads(body or b'{}'), id=f'event{number}', status='confirmed')
+        return 404, {'error': {'code': 404, 'message': f'{path} is not stubbed.'}}
+
+    def answer_batch(self, content_type: str, body: bytes) -> tuple:
+        """
+        This function answers a batch request, each part holds a request of its own and gets
+        its own reply but the whole batch only waits once. This should not be run alone.
+        :param content_type:
+        :param body:
+        :return:
+        """
+        request = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+        if self.latency:
+            sleep(self.latency)
+        parts = []
+        for part in request.get_payload():
+            inner = part.get_payload(decode=False)
+            head, _, data = inner.partition('\r\n\r\n') if '\r\n\r\n' in inner else inner.partition('\n\n')
+            status, reply = self.answer(head.split(' ')[1], data.encode(), wait=False)
+            parts.append(f'Content-Type: application/http\r\nContent-ID: <response-{part["Content-ID"][1:]}\r\n\r\n'
+                         f'HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n\r\n{json.dumps(reply)}')
+        boundary = 'batch_stub_boundary'
+        data = ''.join(f'--{boundary}\r\n{part}\r\n' for part in parts) + f'--{boundary}--\r\n'
+        return f'multipart/mixed; boundary={boundary}', data.encode()
+
+    def discovery_document(self) -> dict:
+        """
+        This function returns a Google Calendar discovery document with only events.insert
+        that points at this server, it can be saved as the Calendar's discovery file.
+        :return:
+        """
+        return {'kind': 'discovery#restDescription', 'discoveryVersion': 'v1', 'id': 'calendar:v3',
+                'name': 'calendar', 'version': 'v3', 'protocol': 'rest',
+                'rootUrl': self.url + '/', 'servicePath': 'calendar/v3/', 'baseUrl': self.url + '/calendar/v3/',
+                'batchPath': 'batch/calendar/v3', 'parameters': {},
+                'schemas': {'Event': {'id': 'Event', 'type': 'object'}},
+                'resources': {'events': {'methods': {'insert': {
+                    'id': 'calendar.events.insert', 'path': 'calendars/{calendarId}/events', 'httpMethod': 'POST',
+                    'parameters': {'calendarId': {'type': 'string', 'required': True, 'location': 'path'}},
+                    'parameterOrder': ['calendarId'], 'request': {'$ref': 'Event'},
+                    'response': {'$ref': 'Event'}}}}}}
@@ -0,0 +1,70 @@
+"""
+Compares the old way of reading Calendly emails, rendering the whole raw email with
+BeautifulSoup and scanning it line by line, against message_text and Event.scrap_info.
+
+    python -m benchmarks.parser --count 2000
+"""
+import argparse
+from time import perf_counter
+
+from bs4 import BeautifulSoup
+
+from main import Event, message_text
+from benchmarks.corpus import corpus
+
+
+def legacy_render(message: bytes) -> str:
+    return BeautifulSoup(message, 'lxml').getText().replace('=E2=80=A2', '-').replace('=E2=80=99', '\'')
+
+
+def legacy_scrap_info(text: str, start: str = 'Event Type:', end: str = 'View event in Calendly'):
+    if start not in text and end not in text:
+        return None
+    months = {'january': '01', 'february': '02', 'march': '03', 'april': '04', 'may': '05', 'june': '06',
+              'july': '07',
+              'august': '08', 'september': '09', 'october': '10', 'november': '11', 'december': '12'}
+    result = {}
+    updated = '\n'.join([m.rstrip('=') for m in text.split('\r\n')])
+    updated = updated[updated.find(start):updated.find(end) + len(end)].split('\n')
+    for i, entry in enumerate(updated):
+        if 'Invitee:' in entry:
+            result['Invitee'] = updated[i + 1]
+        if 'Invitee Email:' in entry:
+            result['Invitee Email'] = updated[i + 1]
+        if 'Event Date/Time' in entry:
+            mtime = updated[i + 1].split('-')[0].strip()
+            result['Time'] = str(int(mtime[:2]) + 12) + mtime[2:5] + ':00' if 'pm' in mtime and mtime[:2] != '12' \
+                else mtime[:5] + ':00'
+            date = updated[i + 1].split(',')[1].split('(')[0].strip().split()
+            date[0] = '0' + date[0] if len(date[0]) == 1 else date[0]
+            result['Date'] = date[2] + '-' + months[date[1].lower()] + '-' + date[0]
+        if 'Invitee Time Zone:' in entry:
+            result['Invitee Time Zone'] = updated[i + 1].split('-')[0].strip()
+    return result
+
+
+def run(name: str, parse, messages: list) -> list:
+    start = perf_counter()
+    results = [parse(message) for message in messages]
+    elapsed = perf_counter() - start
+    print(f'{name:>8}: {elapsed:.3f}s, {len(messages) / elapsed:,.0f} emails/s')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=2000, help='How many emails to parse.')
+    args = parser.parse_args()
+
+    messages = corpus(args.count)
+    event = Event.__new__(Event)
+    old = run('legacy', lambda message: legacy_scrap_info(legacy_render(message)), messages)
+    new = run('fast', lambda message: event.scrap_info(message_text(message)), messages)
+
+    # Non Calendly mail is None for the fast parser but a partial dictionary for the old one.
+    mismatches = sum(1 for a, b in zip(old, new) if b is not None and a != b)
+    print(f'{sum(1 for r in new if r)} events found, {mismatches} results differ from the legacy parser.')
+
+
+if __name__ == '__main__':
+    main()
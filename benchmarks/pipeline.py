@@ -0,0 +1,112 @@
+"""
+Runs the whole core script offline, from downloading the emails to sending the confirmations,
+against the fake servers in benchmarks.fakes and reports how long each stage took.
+
+    python -m benchmarks.pipeline --sizes 100 10000 100000 --latency 0.05
+"""
+import argparse
+import contextlib
+import json
+import os
+import tempfile
+from time import perf_counter
+
+from main import (Alert, Calendar, Gmail, IngestPipeline, Journal, ParseCache, SQLiteDatabase, SyncState, Zoom,
+                  metrics, schedule_new_mail, send_confirmations)
+from benchmarks.corpus import corpus
+from benchmarks.fakes import FakeIMAPServer, SMTPSink, StubAPI
+
+# The stages shown in the report, in the order a message goes through them.
+STAGES = ['imap_uid_search', 'imap_uid_fetch', 'parse_message', 'scrap_info', 'schedule_event',
+          'zoom_create_meeting', 'calendar_batch', 'smtp_send', 'save_db']
+
+
+def run(count: int, args) -> dict:
+    """
+    This function schedules 'count' synthetic emails from start to finish and returns the
+    results with the metrics recorded along the way.
+    :param count:
+    :param args:
+    :return:
+    """
+    from google.oauth2.credentials import Credentials
+
+    start = perf_counter()
+    messages = corpus(count)
+    generated = perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as folder, FakeIMAPServer(messages, args.imap_latency) as imap, \
+            SMTPSink(args.smtp_latency) as smtp, StubAPI(args.latency) as api:
+        gmail = Gmail('tutor', 'password', '127.0.0.1', imap.port, ssl=False)
+        gmail.set_label('Tutoring')
+        alert = Alert('tutor', 'password', '127.0.0.1', smtp.port, ssl=False)
+        zoom = Zoom('benchmark-key', 'benchmark-secret-that-is-32-bytes', rate=args.zoom_rate, api=api.url + '/v2')
+        calendar = Calendar('tutor@example.com', discovery_file=os.path.join(folder, 'calendar_discovery.json'))
+        with open(calendar.discovery_file, 'w') as f:
+            json.dump(api.discovery_document(), f)
+        calendar.service = calendar.build_service(Credentials('benchmark'))
+        database = SQLiteDatabase(os.path.join(folder, 'tutoring.sqlite3'))
+        pipeline = IngestPipeline(database, zoom, calendar, alert, Journal(os.path.join(folder, 'tutoring.journal')),
+                                  workers=args.workers)
+        sync_state = SyncState(os.path.join(folder, 'gmail_sync.json'))
+        # A backfill over several connections needs a parse cache to remember the emails it saw.
+        cache = ParseCache(os.path.join(folder, 'parse_cache.json'), count) if args.connections > 1 else None
+
+        metrics.reset()
+        metrics.enabled = True
+        start = perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            added = schedule_new_mail(database, gmail, pipeline, sync_state, cache, args.connections)
+            sent = send_confirmations(database, alert)
+            alert.close()
+        elapsed = perf_counter() - start
+        metrics.enabled = False
+
+        gmail.connection.logout()
+        database.close()
+        return {'messages': count, 'generated': round(generated, 3), 'seconds': round(elapsed, 3),
+                'per_second': round(count / elapsed, 1), 'added': added, 'confirmations': sent,
+                'emails_sent': smtp.received, 'round_trips': gmail.round_trips,
+                'bytes_received': gmail.bytes_received, 'api_requests': dict(api.requests),
+                'metrics': metrics.summary()}
+
+
+def report(result: dict) -> None:
+    print(f"\n{result['messages']:,} messages in {result['seconds']:.2f}s, {result['per_second']:,.0f} messages/s "
+          f"({result['generated']:.1f}s to generate them)")
+    print(f"{result['added']:,} events added, {result['emails_sent']:,} emails sent, "
+          f"{result['round_trips']:,} IMAP round trips, {result['bytes_received'] / 1e6:.1f} MB downloaded")
+    print(f"{'stage':>20} {'count':>8} {'mean ms':>9} {'p95 ms':>8} {'total s':>8} {'errors':>7}")
+    stages = result['metrics']['stages']
+    for name in STAGES + sorted(set(stages) - set(STAGES)):
+        if name in stages:
+            stage = stages[name]
+            print(f"{name:>20} {stage['count']:>8,} {stage['mean'] * 1000:>9.3f} {stage['p95'] * 1000:>8.2f} "
+                  f"{stage['total']:>8.2f} {stage['errors']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10000, 100000],
+                        help='How many emails to run with, each size is a separate run.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds the Zoom and Calendar stubs wait.')
+    parser.add_argument('--imap-latency', type=float, default=0.0, help='Seconds the IMAP server waits per command.')
+    parser.add_argument('--smtp-latency', type=float, default=0.0, help='Seconds the SMTP sink waits per message.')
+    parser.add_argument('--zoom-rate', type=float, default=1000, help='Zoom requests allowed per second.')
+    parser.add_argument('--workers', type=int, default=4, help='Events the pipeline works on at the same time.')
+    parser.add_argument('--connections', type=int, default=1,
+                        help='IMAP connections used to backfill more than 1000 emails, 1 downloads them over one.')
+    parser.add_argument('--json', metavar='FILE', help='Also save every result to this file.')
+    args = parser.parse_args()
+
+    results = []
+    for count in args.sizes:
+        results.append(run(count, args))
+        report(results[-1])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Measures how long it takes to import main.py (or the database viewer) in a fresh interpreter
+using python -X importtime, and fails if it is over the budget.
+
+    python -m benchmarks.startup --budget 0.25
+    python -m benchmarks.startup --viewer --budget 0.8
+"""
+import argparse
+import subprocess
+import sys
+
+VIEWER = "import importlib.machinery; importlib.machinery.SourceFileLoader('database_viewer', " \
+         "'database_viewer.pyw').load_module()"
+
+
+def import_times(code: str) -> dict:
+    """
+    This function runs the code in a new interpreter and returns the cumulative import time
+    of every top level module it imported, in seconds.
+    :param code:
+    :return:
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(result.stderr)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Only modules imported directly by the code have no indentation.
+        if not name[1:].startswith(' '):
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--viewer', action='store_true', help='Measure the database viewer instead of main.py.')
+    parser.add_argument('--budget', type=float, default=None, help='Seconds allowed, 0.25 for main, 0.8 for the viewer.')
+    parser.add_argument('--runs', type=int, default=5, help='The fastest of this many runs is used.')
+    args = parser.parse_args()
+    budget = args.budget or (0.8 if args.viewer else 0.25)
+
+    # Everything the interpreter loads before running any code is not our cost.
+    baseline = min(sum(import_times('pass').values()) for _ in range(args.runs))
+    runs = [import_times(VIEWER if args.viewer else 'import main') for _ in range(args.runs)]
+    fastest = min(runs, key=lambda times: sum(times.values()))
+    total = sum(fastest.values()) - baseline
+
+    for name, seconds in sorted(fastest.items(), key=lambda item: item[1], reverse=True)[:10]:
+        print(f'{seconds * 1000:8.1f} ms  {name}')
+    print(f'{total * 1000:8.1f} ms  total, the budget is {budget * 1000:.0f} ms')
+    if total > budget:
+        print('Over budget!')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
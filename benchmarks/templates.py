@@ -0,0 +1,135 @@
+"""
+Compares writing and building confirmation emails the old way, an f-string per event and the
+image read and encoded again for every email, against the compiled templates and the shared
+attachment from load_attachment.
+
+    python -m benchmarks.templates --count 10000
+"""
+import argparse
+import datetime
+import imghdr
+import os
+import random
+import tempfile
+import zlib
+from email.message import EmailMessage
+from struct import pack
+from time import perf_counter
+
+from main import Alert, Event, confirmation_email, load_attachment
+
+
+def legacy_confirmation_email(event) -> tuple:
+    subject = f'Cybersecurity Boot Camp - Tutorial Confirmation - {event.get_day_of_week()}, {event.get_month()} ' \
+              f'{event.get_suffix()}, at {event.get_standard_time()}, Pacific.'
+
+    message = f'Hi {event.invitee.split(" ")[0]}!\n' \
+              f'Thank you for scheduling your session with me. I am looking forward to our session on ' \
+              f'{event.get_day_of_week()}, {event.get_month()} {event.get_suffix()}, at ' \
+              f'{event.get_standard_time()}, Pacific.\n\n' \
+              f'If something comes up and the scheduled time will not work, let me know a minimum of 6 hours' \
+              f' before the appointment time and we’ll figure something out.\n\n' \
+              f'This session will take place here:\n\n' \
+              f'Join Zoom Meeting\n' \
+              f'{event.zoom_join_url}\n\n' \
+              f'Meeting ID: {event.zoom_id}\n' \
+              f'Passcode: {event.zoom_passcode}\n\n' \
+              f'(If you have not used zoom before please join the meeting at least 15 minutes early because it' \
+              f' may have you download and install some software.)\n\n' \
+              f'Again, all I need from you:\n' \
+              f'• Be on Tutors & Students Slack 5 minutes before your time slot.\n' \
+              f'• Make sure your computer/mic/internet connection is working.\n' \
+              f'• Make sure your workspace is quiet and free from interruptions.\n' \
+              f'• At the end of the session, I will provide you with a link to a 2-minute evaluation form ' \
+              f'that you are required to complete.\n\n' \
+              f'Slack or email me with any questions. I’m looking forward to our meeting!\n\n' \
+              f'Please Reply All to this email so that I know you have seen it.\n\n' \
+              f'(CC Central Support on all tutor emails by always using REPLY ALL).\n\n' \
+              f'Sincerely,\n' \
+              f'YOUR NAME\n'
+    return subject, message
+
+
+def legacy_build(receiver: str, message: str, subject: str, image: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg['Subject'] = subject
+    msg['From'] = None
+    msg['To'] = receiver
+    msg['Cc'] = None
+    msg.set_content(message)
+    with open(image, 'rb') as f:
+        file_data = f.read()
+        file_type = imghdr.what(f.name)
+        file_name = f.name
+    msg.add_attachment(file_data, maintype='image', subtype=file_type, filename=file_name)
+    return msg
+
+
+def write_png(path: str, size: int = 256) -> None:
+    """
+    This function writes a noisy grayscale PNG about size * size bytes big to attach.
+    :param path:
+    :param size:
+    :return:
+    """
+    rng = random.Random(1)
+    rows = b''.join(b'\x00' + bytes(rng.randrange(256) for _ in range(size)) for _ in range(size))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return pack('>I', len(data)) + kind + data + pack('>I', zlib.crc32(kind + data))
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', pack('>IIBBBBB', size, size, 8, 0, 0, 0, 0)) +
+                chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+def events(count: int) -> list:
+    rng = random.Random(1)
+    today = datetime.date.today()
+    return [Event.from_record({'invitee': f'Student {number} Example', 'invitee_email': f'student{number}@example.com',
+                               'date': str(today + datetime.timedelta(days=rng.randint(0, 60))),
+                               'time': f'{rng.randint(8, 20):02}:{rng.choice([0, 30]):02}:00', 'notified': False,
+                               'zoom_id': 85000000000 + number, 'zoom_join_url': f'https://zoom.us/j/{number}',
+                               'zoom_passcode': 'x7Kq2p'}) for number in range(count)]
+
+
+def run(name: str, work, items: list) -> list:
+    start = perf_counter()
+    results = [work(item) for item in items]
+    elapsed = perf_counter() - start
+    print(f'{name:>16}: {elapsed:.3f}s, {len(items) / elapsed:,.0f} emails/s')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=10000, help='How many emails to write and build.')
+    parser.add_argument('--image-size', type=int, default=256, help='Width of the attached image, 0 for none.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        image = os.path.join(folder, 'flyer.png')
+        if args.image_size:
+            write_png(image, args.image_size)
+        alert = Alert('tutor', 'password')
+        booked = events(args.count)
+
+        old = run('legacy render', legacy_confirmation_email, booked)
+        new = run('template render', confirmation_email, booked)
+        print(f'{sum(a != b for a, b in zip(old, new))} emails differ between the two.')
+
+        work = list(zip(booked, new))
+        if args.image_size:
+            legacy = run('legacy build', lambda item: legacy_build(item[0].invitee_email, item[1][1], item[1][0],
+                                                                   image), work)
+            built = run('shared build', lambda item: alert.Build(item[0].invitee_email, item[1][1], item[1][0],
+                                                                  load_attachment(image)), work)
+            run('legacy as bytes', lambda msg: msg.as_bytes(), legacy)
+            run('shared as bytes', lambda msg: msg.as_bytes(), built)
+        else:
+            built = run('build', lambda item: alert.Build(item[0].invitee_email, item[1][1], item[1][0]), work)
+            run('as bytes', lambda msg: msg.as_bytes(), built)
+
+
+if __name__ == '__main__':
+    main()
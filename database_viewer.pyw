@@ -1,9 +1,15 @@
 from main import *
 import main
+import contextlib
+import threading
 import PySimpleGUI as sg
 
+# How long to wait after the last keystroke before searching, in milliseconds.
+SEARCH_DELAY = 200
 
-class Event:
+
+class Event(EventBase):
+    __slots__ = ()
 
     def __init__(self, name, email, time_, date, notified, timezone, zoom_url, zoom_passcode, zoom_id):
         self.valid = True
@@ -17,70 +23,70 @@ class Event:
         self.zoom_join_url = zoom_url
         self.zoom_passcode = zoom_passcode
 
-    def __str__(self):
-        """
-        This function is called upon if you try to print this class object. It will format the
-        response so its easier to read.
-        :return:
-        """
-        return f'\n' \
-               f'Invitee: {self.invitee}\n' \
-               f'Invitee Email: {self.invitee_email}\n' \
-               f'Invitee Timezone: {self.invitee_timezone}\n' \
-               f'Event Start: {self.time} {self.date}\n' \
-               f'Zoom ID: {self.zoom_id}\n' \
-               f'Zoom Meeting Url: {self.zoom_join_url}\n' \
-               f'Zoom Passcode: {self.zoom_passcode}\n' \
-               f'Notified: {str(self.notified)}'
-
-    def convert_date(self) -> datetime.date:
-        """
-        This function converts the string date to a datetime.date object so it can
-        be compared to other datetime.date objects.
-        :return:
-        """
-        event_date = self.date.split('-')
-        return datetime.datetime(int(event_date[0]), int(event_date[1]), int(event_date[2])).date()
 
-    def get_day_of_week(self) -> str:
-        """
-        This function converts the date of the event to the day of the week.
-        :return:
-        """
-        return self.convert_date().strftime('%A')
+class NameIndex:
 
-    def get_month(self) -> str:
+    def __init__(self, size: int = 3):
         """
-        This function converts the date of the event to a month of the year.
-        :return:
+        This class keeps a copy of the events in memory with every piece of each name up to
+        size letters long pointing at the events that contain it, so searching while typing
+        does not have to read the database or look at every event.
+        :param size:
         """
-        return self.convert_date().strftime('%B')
-
-    def get_suffix(self) -> str:
+        self.size = size
+        self.version = None
+        self.events = []
+        self.grams = {}
+        self.last_name = None
+        self.last_found = set()
+
+    def refresh(self, db) -> bool:
         """
-        This function return the day with a suffix appended to it.
+        This function reloads the events only if the database has changed since they were
+        last loaded. It returns True if they were reloaded.
+        :param db:
         :return:
         """
-        day = self.convert_date().day
-        suffix = 'th' if 11 <= day <= 13 else {1: 'st', 2: 'nd', 3: 'rd'}.get(day % 10, 'th')
-        return str(day) + suffix
-
-    def get_standard_time(self) -> str:
+        version = db.version()
+        if version == self.version:
+            return False
+        self.version = version
+        self.events = db.event_data
+        self.grams = {}
+        for position, event in enumerate(self.events):
+            name = event.invitee.lower()
+            for gram in {name[i:i + n] for n in range(1, self.size + 1) for i in range(len(name) - n + 1)}:
+                self.grams.setdefault(gram, set()).add(position)
+        self.last_name = None
+        return True
+
+    def search(self, name: str) -> set:
         """
-        This function converts military time back to standard time.
+        This function returns the positions of the events with the name in them. When the
+        name only adds letters to the last search the last results are narrowed down instead.
+        :param name:
         :return:
         """
-        return datetime.datetime.strptime(self.time, '%H:%M:%S').strftime('%I:%M %p')
-
-    def end_time(self):
-        return (datetime.datetime.strptime(self.time, '%H:%M:%S') + datetime.timedelta(minutes=50)).time()
+        name = name.lower()
+        if not name:
+            return set(range(len(self.events)))
+        if self.last_name and name.startswith(self.last_name):
+            found = {position for position in self.last_found if name in self.events[position].invitee.lower()}
+        elif len(name) <= self.size:
+            found = set(self.grams.get(name, ()))
+        else:
+            grams = [self.grams.get(name[i:i + self.size], set()) for i in range(len(name) - self.size + 1)]
+            found = {position for position in set.intersection(*grams)
+                     if name in self.events[position].invitee.lower()}
+        self.last_name, self.last_found = name, found
+        return found
 
 
 def gather_search_results_by_name(names):
-    result = []
+    found = set()
     for name in names.split(';'):
-        result.extend(database.search_by_name(name.strip()))
-    return list(set(result))
+        found |= name_index.search(name.strip())
+    return [name_index.events[position] for position in found]
 
 
 def gather_search_results_by_date(year, month, day):
@@ -113,6 +119,36 @@ def display_results(results: list):
             f' {event.time} ({event.get_standard_time()})' for event in results]
 
 
+def update_results(listbox, lines: list) -> None:
+    """
+    This function changes only the rows of the list that are different instead of
+    rebuilding the whole list, so typing a search does not redraw thousands of rows.
+    :param listbox:
+    :param lines:
+    :return:
+    """
+    old = list(listbox.get_list_values())
+    if old == lines:
+        return
+    start = 0
+    while start < min(len(old), len(lines)) and old[start] == lines[start]:
+        start += 1
+    end = 0
+    while end < min(len(old), len(lines)) - start and old[-1 - end] == lines[-1 - end]:
+        end += 1
+    if start < len(old) - end:
+        listbox.Widget.delete(start, len(old) - end - 1)
+    if start < len(lines) - end:
+        listbox.Widget.insert(start, *lines[start:len(lines) - end])
+    listbox.Values = lines
+
+
+def show_results(window, events: list, sort_by: str) -> list:
+    shown = sort_results(events, sort_by)
+    update_results(window['-results-'], display_results(shown))
+    return shown
+
+
 def display_expanded_result(event, values):
     if not event:
         return 'No Result Selected.'
@@ -138,6 +174,66 @@ def display_expanded_result(event, values):
     return extended
 
 
+class WindowWriter:
+
+    def __init__(self, window, key: str = '-progress-'):
+        """
+        This class stands in for the console while the core script runs in the background,
+        every line it prints is sent to the window as an event instead.
+        :param window:
+        :param key:
+        """
+        self.window = window
+        self.key = key
+        self.line = ''
+
+    def write(self, text: str) -> int:
+        self.line += text
+        *lines, self.line = self.line.split('\n')
+        for line in lines:
+            if line.strip():
+                self.window.write_event_value(self.key, line.strip())
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+
+def run_core_script(window):
+    """
+    This function runs the core script off the GUI thread and tells the window when it is
+    done, with the error if it failed.
+    :param window:
+    :return:
+    """
+    error = None
+    try:
+        with contextlib.redirect_stdout(WindowWriter(window)):
+            main.main()
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    window.write_event_value('-core_done-', error)
+
+
+def save_new_event(window, new_event):
+    """
+    This function creates the zoom meeting and calendar event for a new event off the GUI
+    thread and tells the window if it was added or why not.
+    :param window:
+    :param new_event:
+    :return:
+    """
+    try:
+        if database.append_event(new_event, zoom, calendar):
+            save_db(database)
+            response = 'The Event Was Added Successfully!'
+        else:
+            response = 'The Event Was Not Added, It Is Already Saved Or In The Past.'
+    except Exception as e:
+        response = f'The Event Could Not Be Added.\n{type(e).__name__}: {e}'
+    window.write_event_value('-added-', response)
+
+
 def check_values(values):
     explanation = ''
     if '@' not in values['-email-']:
@@ -197,11 +293,19 @@ def add_new_event():
 
     layout = [fill_out]
     window = sg.Window('Add New Events.', layout, resizable=True)
+    saving = None
 
     while True:
         event, values = window.read()
         if event == sg.WIN_CLOSED or event == '-exit-':
+            if saving and saving.is_alive():
+                # The window has to stay open to hear back from the worker.
+                sg.Popup('The Event Is Still Being Saved, Please Wait.')
+                continue
             break
+        if event == '-added-':
+            window['-submit-'].update(disabled=False)
+            sg.Popup(values['-added-'])
         if event == '-submit-':
             response = check_values(values)
             if not response:
@@ -240,9 +344,10 @@ def add_new_event():
                 new_event = Event(values['-name-'], values['-email-'], time_, date,
                                   True if values['-notified-'] == 'True' else False, values['-timezone-'],
                                   values['-zoom_url-'], values['-zoom_passcode-'], str(values['-zoom_id-']))
-                database.append_event(new_event, zoom, calendar)
-                save_db(database)
-                sg.Popup('The Event Was Added Successfully!')
+                # Zoom and the calendar are slow so they are done in the background.
+                window['-submit-'].update(disabled=True)
+                saving = threading.Thread(target=save_new_event, args=(window, new_event), daemon=True)
+                saving.start()
             else:
                 sg.Popup(response)
 
@@ -251,7 +356,12 @@ def add_new_event():
 
 def start_window():
     global database
+    name_index.refresh(database)
     search_results = sort_results_by_name(gather_search_results_by_name(''))
+    shown = search_results
+    last_search = lambda: gather_search_results_by_name('')
+    search_pending = False
+    core_script = None
     extended_view_event = None
     menu = [['Run', 'Core Script']]
 
@@ -270,7 +380,8 @@ def start_window():
         [sg.HSeparator()],
         [sg.Text('Sort Search By: '), sg.Combo(['Name', 'Date', 'Time'], 'Name',
                                                enable_events=True, size=(15, 1), key='-sort_by-')],
-        [sg.Listbox(display_results(search_results), s=(52, 10), key='-results-', bind_return_key=True)]
+        [sg.Listbox(display_results(search_results), s=(52, 10), key='-results-', bind_return_key=True)],
+        [sg.Text('', size=(52, 1), key='-status-')]
     ]
 
     info = [
@@ -296,23 +407,39 @@ def start_window():
     window = sg.Window('Tutoring Database Viewer.', layout)
 
     while True:
-        event, values = window.read()
+        event, values = window.read(timeout=SEARCH_DELAY if search_pending else None)
 
         if event == sg.WIN_CLOSED:
+            # A core script still running is stopped with the window, the journal lets
+            # the next run finish anything it left half done.
             break
-        database = open_db()
-        if event == '-search_name-' or event == '-name_searched-':
-            search_results = gather_search_results_by_name(values['-name_searched-'])
-            window['-results-'].update(display_results(sort_results(search_results, values['-sort_by-'])))
+        # The events are only reloaded when something has changed them.
+        if name_index.refresh(database):
+            search_results = last_search()
+            shown = show_results(window, search_results, values['-sort_by-'])
+        if event == '-name_searched-':
+            # Waits until typing stops before searching.
+            search_pending = True
+            continue
+        if event == '-search_name-' or (event == sg.TIMEOUT_KEY and search_pending):
+            search_pending = False
+            names = values['-name_searched-']
+            last_search = lambda: gather_search_results_by_name(names)
+            search_results = last_search()
+            shown = show_results(window, search_results, values['-sort_by-'])
         if event == '-search_date-':
-            search_results = gather_search_results_by_date(values['-year-'], values['-month-'], values['-day-'])
-            window['-results-'].update(display_results(sort_results(search_results, values['-sort_by-'])))
+            date = values['-year-'], values['-month-'], values['-day-']
+            last_search = lambda: gather_search_results_by_date(*date)
+            search_results = last_search()
+            shown = show_results(window, search_results, values['-sort_by-'])
         if event == '-sort_by-':
-            window['-results-'].update(display_results(sort_results(search_results, values['-sort_by-'])))
+            shown = show_results(window, search_results, values['-sort_by-'])
         if event == '-results-':
-            result = values['-results-'][0].split(', ')
-            extended_view_event = database.search_by_name_date_time(result[0], result[1], result[2].split(' ')[0])
-            window['-expanded_view-'].update(display_expanded_result(extended_view_event, values))
+            selected = window['-results-'].get_indexes()
+            if selected:
+                result = shown[selected[0]]
+                extended_view_event = database.search_by_name_date_time(result.invitee, result.date, result.time)
+                window['-expanded_view-'].update(display_expanded_result(extended_view_event, values))
         if 'grab' in event:
             window['-expanded_view-'].update(display_expanded_result(extended_view_event, values))
         if event == '-add_event-':
@@ -331,24 +458,33 @@ def start_window():
             if not database.remove_event(extended_view_event):
                 sg.Popup('Count Not Find Event In Database.')
                 continue
-            for count, event in enumerate(search_results):
-                if (event.invitee, event.date, event.time) == (extended_view_event.invitee,
-                                                               extended_view_event.date,
-                                                               extended_view_event.time):
-                    del search_results[count]
             extended_view_event = None
             window['-expanded_view-'].update(display_expanded_result(extended_view_event, values))
-            window['-results-'].update(display_results(sort_results(search_results, values['-sort_by-'])))
             save_db(database)
         if event == 'Core Script':
-            main.main()
-            database = open_db()
+            if core_script and core_script.is_alive():
+                sg.Popup('The Core Script Is Already Running.')
+                continue
+            window['-status-'].update('Running the core script...')
+            core_script = threading.Thread(target=run_core_script, args=(window,), daemon=True)
+            core_script.start()
+        if event == '-progress-':
+            window['-status-'].update(values['-progress-'])
+        if event == '-core_done-':
+            if values['-core_done-']:
+                window['-status-'].update('The core script failed.')
+                sg.Popup(f'The Core Script Failed.\n{values["-core_done-"]}')
+            else:
+                window['-status-'].update('The core script has finished.')
+        if event in ('-add_event-', '-delete-', '-core_done-') and name_index.refresh(database):
+            search_results = last_search()
+            shown = show_results(window, search_results, values['-sort_by-'])
 
     window.close()
 
 
 def _main():
-    global database, zoom, calendar
+    global database, zoom, calendar, name_index
 
     # Logging into Zoom with 'key' and 'secret' credentials. Here is a tutorial on the zoom
     # api: https://www.geeksforgeeks.org/how-to-create-a-meeting-with-zoom-api-in-python/
@@ -364,6 +500,7 @@ def _main():
     calendar = Calendar('YOURGMAIL@gmail.com')
 
     database = open_db()
+    name_index = NameIndex()
 
     # sg.theme('DarkPurple4')
     sg.theme('DarkBlack')
@@ -1,39 +1,330 @@
 import imaplib
+import select
+import ssl
+import argparse
 import smtplib
-from email.message import EmailMessage
+from email.message import EmailMessage, MIMEPart
 import imghdr
 import threading
-from time import time, sleep
+import queue
+from time import time, sleep, monotonic, perf_counter
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor, Future
+from email.utils import parsedate_to_datetime, parseaddr
 import json
-import jwt
-import requests
-from bs4 import BeautifulSoup
+import hashlib
+from collections import OrderedDict, deque
 import datetime
+import bisect
 import pickle
+import gzip
+import sqlite3
 import os.path
-import http.client as http
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+import re
+from email.parser import BytesHeaderParser
+import email
 
 # To install all required modules: pip install -r requirements.txt
 # If on linux use pip3
+# The google client, requests, jwt and BeautifulSoup are only imported once they are needed so
+# opening the database viewer does not have to load them.
+
+# Finds the UID of a message within an IMAP FETCH response.
+FETCH_UID = re.compile(rb'UID (\d+)')
+# Finds each field of a Calendly notification, the value is on the first line with text after the label.
+CALENDLY_FIELD = re.compile(r'^[ \t]*(Invitee|Invitee Email|Event Date/Time|Invitee Time Zone):(?:[ \t]*\n)+'
+                            r'[ \t]*([^\n]*?)[ \t]*$', re.M)
+# Splits up a Calendly date such as '04:00pm - Monday, 13 September 2021 (Pacific Time - US & Canada)'.
+CALENDLY_WHEN = re.compile(r'(\d{1,2}):(\d{2})\s*([ap]m)\s*-\s*[^,]*,\s*(\d{1,2})\s+([a-z]+)\s+(\d{4})', re.I)
+# Finds the Message-ID in the headers of a raw email.
+MESSAGE_ID = re.compile(rb'^Message-ID:[ \t]*(<[^>\r\n]+>)', re.I | re.M)
+# Finds a phone number sent to through an email to text gateway, such as 5551234567@tmomail.net.
+GATEWAY_ADDRESS = re.compile(rb'(?<![\d.+])(\d{7,15})(@[A-Za-z0-9.-]+\.[A-Za-z]+)')
+# The fields of an event that are saved to the database.
+EVENT_FIELDS = ('invitee', 'invitee_email', 'invitee_timezone', 'date', 'time', 'notified', 'zoom_id',
+                'zoom_join_url', 'zoom_passcode')
+MONTHS = {'january': '01', 'february': '02', 'march': '03', 'april': '04', 'may': '05', 'june': '06',
+          'july': '07', 'august': '08', 'september': '09', 'october': '10', 'november': '11', 'december': '12'}
+
+
+def write_atomically(path: str, data: str) -> None:
+    """
+    This function replaces a file in one step, the data is written to path.tmp and moved over
+    the file once it is on disk, so a crash or anything reading it never sees half a file.
+    :param path:
+    :param data:
+    :return:
+    """
+    with open(path + '.tmp', 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+class Metrics:
+
+    # The upper edge of each latency bucket in seconds, Prometheus' defaults with a few more below
+    # 5ms since parsing an email takes well under a millisecond.
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+               float('inf'))
+
+    def __init__(self):
+        """
+        This class records how long each stage of a run takes, how often it fails and counts
+        such as bytes downloaded. It does nothing until enabled, which is one attribute check
+        per instrumented call, so it can stay in place.
+        """
+        self.enabled = False
+        self.summary_file = None
+        self.prometheus_file = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def enable(self, summary_file: str = 'tutoring_metrics.json', prometheus_file: str = None) -> None:
+        """
+        This function turns recording on. The summary is written as JSON and the prometheus
+        file, if given, in the text format the node exporter textfile collector reads.
+        :param summary_file:
+        :param prometheus_file:
+        :return:
+        """
+        self.summary_file = summary_file
+        self.prometheus_file = prometheus_file
+        self.enabled = True
+
+    def reset(self) -> None:
+        with self.lock:
+            self.started = time()
+            self.timings = {}
+            self.counters = {}
+
+    def observe(self, name: str, seconds: float, error: bool = False) -> None:
+        """
+        This function records one call of a stage that took 'seconds'.
+        :param name:
+        :param seconds:
+        :param error:
+        :return:
+        """
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = {'count': 0, 'errors': 0, 'sum': 0.0, 'max': 0.0,
+                                               'buckets': [0] * len(self.BUCKETS)}
+            timing['count'] += 1
+            timing['errors'] += error
+            timing['sum'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+            timing['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    def count(self, name: str, value: int = 1) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def percentile(self, timing: dict, fraction: float) -> float:
+        """
+        This function estimates a percentile from the buckets, it is the upper edge of the
+        bucket the percentile falls in. This should not be run alone.
+        :param timing:
+        :param fraction:
+        :return:
+        """
+        seen = 0
+        for edge, count in zip(self.BUCKETS, timing['buckets']):
+            seen += count
+            if seen >= fraction * timing['count']:
+                return round(min(edge, timing['max']), 6)
+        return round(timing['max'], 6)
+
+    def summary(self) -> dict:
+        """
+        This function returns the timings and counters recorded since the last reset.
+        :return:
+        """
+        with self.lock:
+            return {'started': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                    'seconds': round(time() - self.started, 3),
+                    'stages': {name: {'count': timing['count'],
+                                      'errors': timing['errors'],
+                                      'error_rate': round(timing['errors'] / timing['count'], 4),
+                                      'total': round(timing['sum'], 6),
+                                      'mean': round(timing['sum'] / timing['count'], 6),
+                                      'p50': self.percentile(timing, 0.5),
+                                      'p95': self.percentile(timing, 0.95),
+                                      'max': round(timing['max'], 6)}
+                               for name, timing in sorted(self.timings.items())},
+                    'counters': dict(sorted(self.counters.items()))}
+
+    def prometheus(self) -> str:
+        """
+        This function returns the timings and counters in the prometheus text format.
+        :return:
+        """
+        lines = ['# TYPE tutoring_stage_seconds histogram']
+        with self.lock:
+            for name, timing in sorted(self.timings.items()):
+                total = 0
+                for edge, count in zip(self.BUCKETS, timing['buckets']):
+                    total += count
+                    le = '+Inf' if edge == float('inf') else repr(edge)
+                    lines.append(f'tutoring_stage_seconds_bucket{{stage="{name}",le="{le}"}} {total}')
+                lines.append(f'tutoring_stage_seconds_sum{{stage="{name}"}} {timing["sum"]:.6f}')
+                lines.append(f'tutoring_stage_seconds_count{{stage="{name}"}} {timing["count"]}')
+            lines.append('# TYPE tutoring_stage_errors_total counter')
+            for name, timing in sorted(self.timings.items()):
+                lines.append(f'tutoring_stage_errors_total{{stage="{name}"}} {timing["errors"]}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'# TYPE tutoring_{name}_total counter')
+                lines.append(f'tutoring_{name}_total {value}')
+        return '\n'.join(lines) + '\n'
+
+    def publish(self) -> None:
+        """
+        This function writes the summary and the prometheus file if recording is on.
+        :return:
+        """
+        if not self.enabled:
+            return
+        for file, text in ((self.summary_file, lambda: json.dumps(self.summary(), indent=4)),
+                           (self.prometheus_file, self.prometheus)):
+            if file:
+                write_atomically(file, text())
+
+
+# Everything in this file records to the same metrics, turned on with --metrics.
+metrics = Metrics()
+
+
+def instrument(name: str):
+    """
+    This function is a decorator that times every call of a function as the stage 'name'
+    and counts the calls that raise, only while metrics are enabled.
+    :param name:
+    :return:
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return function(*args, **kwargs)
+            start = perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except BaseException:
+                metrics.observe(name, perf_counter() - start, error=True)
+                raise
+            metrics.observe(name, perf_counter() - start)
+            return result
+        return wrapper
+    return decorator
 
 
 class Gmail:
 
     def __init__(self, username: str, password: str, imap: str = 'imap.gmail.com',
-                 port: int = 993, timeout: int = 5, look_pretty: bool = True):
+                 port: int = 993, timeout: int = 5, look_pretty: bool = True, connect: bool = True,
+                 ssl: bool = True):
         self.username = username
         self.password = password
         self.imap = imap
         self.port = port
+        # Only a local test server should ever be used without SSL.
+        self.ssl = ssl
         self.timeout = timeout
         self.look_pretty = look_pretty
-        self.connection = imaplib.IMAP4_SSL(self.imap, self.port)
+        # Keeps track of how much work is done talking to the server.
+        self.round_trips = 0
+        self.bytes_received = 0
+        self.label = None
+        self.uidvalidity = None
+        # Passing connect=False leaves logging in to reconnect, for example from a SessionManager.
+        self.connection = None
+        if connect:
+            self.reconnect()
+
+    def reconnect(self):
+        """
+        This function throws away the current connection, logs in on a new one and selects
+        the label that was being looked at.
+        :return:
+        """
+        if self.connection is not None:
+            try:
+                self.connection.shutdown()
+            except Exception:
+                pass
+        self.connection = (imaplib.IMAP4_SSL if self.ssl else imaplib.IMAP4)(self.imap, self.port)
         self.login()
+        if self.label:
+            self.set_label(self.label)
+
+    def idle(self, timeout: float = 25 * 60) -> bool:
+        """
+        This function uses IMAP IDLE to wait for the server to tell us new mail has arrived in
+        the selected label. It returns True if new mail arrived or False if the time ran out.
+        Gmail ends an IDLE after 29 minutes so the timeout should stay below that. If the
+        server already reported new mail during an earlier command it returns True right away.
+        :param timeout:
+        :return:
+        """
+        if self.connection.untagged_responses.pop('EXISTS', None):
+            return True
+        tag = self.connection._new_tag()
+        self.connection.send(tag + b' IDLE\r\n')
+        line = self.connection.readline()
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.error(f'IDLE was refused: {line!r}')
+        new_mail = False
+        deadline = monotonic() + timeout
+        while not new_mail:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            # Waiting on the socket instead of a socket timeout keeps the buffered reader usable.
+            if not self.buffered():
+                readable, _, _ = select.select([self.connection.sock], [], [], remaining)
+                if not readable:
+                    break
+            line = self.connection.readline()
+            if not line:
+                raise imaplib.IMAP4.abort('The server closed the connection during IDLE.')
+            new_mail = line.rstrip().endswith(b'EXISTS')
+        self.connection.send(b'DONE\r\n')
+        while True:
+            line = self.connection.readline()
+            if not line:
+                raise imaplib.IMAP4.abort('The server closed the connection during IDLE.')
+            if line.startswith(tag):
+                break
+            new_mail = new_mail or line.rstrip().endswith(b'EXISTS')
+        self.round_trips += 1
+        return new_mail
+
+    def buffered(self) -> bool:
+        """
+        This function returns if data from the server was already read into the SSL layer or
+        imaplib's reader but not handed over yet, select can not see it. This should not be
+        run alone.
+        :return:
+        """
+        sock = self.connection.sock
+        if hasattr(sock, 'pending') and sock.pending():
+            return True
+        # Peeking would wait for the server when nothing is buffered, so the socket stops waiting for a moment.
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return bool(self.connection.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            sock.settimeout(timeout)
 
+    @instrument('gmail_login')
     def login(self):
         """
         This function logs in with the credentials provided. This is outside of the init function
@@ -53,40 +344,795 @@ class Gmail:
         for messages in data[::-1]:
             for message in messages:
                 if type(message) is tuple:
-                    if self.look_pretty:
-                        result.append(BeautifulSoup(message[1], 'lxml').getText()
-                                      .replace('=E2=80=A2', '-').replace('=E2=80=99', '\''))
-                    else:
-                        result.append(message[1])
+                    result.append(self.render(message[1]))
         return result
 
+    def render(self, message: bytes):
+        """
+        This function turns a single raw email into text if look_pretty is set.
+        :param message:
+        :return:
+        """
+        if self.look_pretty:
+            return message_text(message)
+        return message
+
     def set_label(self, label: str):
         """
-        This function tells the email gatherer where to send its search party.
+        This function tells the email gatherer where to send its search party. It also
+        remembers the UIDVALIDITY of the mailbox so incremental syncs know if their UIDs
+        are still usable.
         :param label:
         :return:
         """
-        return self.connection.select(label)
+        self.label = label
+        if self.connection is None:
+            # The label is selected once reconnect logs in.
+            return None
+        result = self.connection.select(label)
+        # The message count of the select is not new mail, only an EXISTS after this is.
+        self.connection.untagged_responses.pop('EXISTS', None)
+        _, validity = self.connection.response('UIDVALIDITY')
+        self.uidvalidity = int(validity[0]) if validity and validity[0] else None
+        return result
+
+    def get_messages(self, search: str = '(ALL)', sync_state=None, batch_size: int = 0,
+                     sender: str = None) -> list:
+        """
+        This function searches and checks for any emails within the search parameters and returns
+        them newest first. Look at iter_messages for what the other parameters do.
+        :param search:
+        :param sync_state:
+        :param batch_size:
+        :param sender:
+        :return:
+        """
+        return list(self.iter_messages(search, sync_state, batch_size, sender))[::-1]
 
-    def get_messages(self, search: str = '(ALL)') -> list:
+    def iter_messages(self, search: str = '(ALL)', sync_state=None, batch_size: int = 0, sender: str = None):
         """
-        This function searches and checks for any emails within the search parameters.
+        This function yields the emails within the search parameters one at a time, oldest first,
+        so only one batch is held in memory and work can start on the first email right away.
+        If a SyncState is provided only the messages that arrived since the last sync of this
+        label are downloaded and the state is moved forward as each email is handed over, it
+        is up to the caller to save it. Setting a batch size downloads that many messages per
+        request instead of one at a time, and setting a sender first looks at the headers so
+        only mail from that sender is downloaded.
         :param search:
+        :param sync_state:
+        :param batch_size:
+        :param sender:
         :return:
         """
-        _, result = self.connection.search(None, search)
-        data = []
-        for num in result[0].split():
-            _, msg = self.connection.fetch(num, '(RFC822)')
-            data.append(msg)
-        return self.get_body(data)
+        if sync_state is None and not batch_size:
+            _, result = self.command('SEARCH', None, search)
+            for num in result[0].split():
+                _, msg = self.command('FETCH', num, '(RFC822)')
+                for message in msg:
+                    if type(message) is tuple:
+                        yield self.render(message[1])
+            return
+
+        last_uid = sync_state.last_uid(self.label, self.uidvalidity) if sync_state else 0
+        uids = self.search_uids(search, last_uid)
+        for start in range(0, len(uids), batch_size or 1):
+            chunk = uids[start:start + (batch_size or 1)]
+            wanted = self.filter_sender(chunk, sender) if sender else chunk
+            for uid, message in self.fetch_messages(wanted):
+                yield self.render(message)
+                if sync_state:
+                    sync_state.update(self.label, self.uidvalidity, uid)
+        if sync_state and uids:
+            sync_state.update(self.label, self.uidvalidity, uids[-1])
+
+    def iter_events(self, cache, search: str = '(ALL)', sync_state=None, batch_size: int = 200,
+                    sender: str = None, uids: list = None):
+        """
+        This function works like iter_messages but yields the Calendly events themselves and
+        uses a ParseCache so emails seen in an earlier run are neither downloaded nor parsed
+        again, only looked up. Emails that are not events are skipped instead of being yielded.
+        UIDs that were already searched for can be passed in so the search is not sent again.
+        :param cache:
+        :param search:
+        :param sync_state:
+        :param batch_size:
+        :param sender:
+        :param uids:
+        :return:
+        """
+        if uids is None:
+            uids = self.search_uids(search, sync_state.last_uid(self.label, self.uidvalidity) if sync_state else 0)
+        for start in range(0, len(uids), batch_size):
+            chunk = uids[start:start + batch_size]
+            missing = self.uncached(cache, chunk)
+            wanted = self.filter_sender(missing, sender) if sender else missing
+            for uid, event in self.cached_events(cache, chunk, missing, dict(self.fetch_messages(wanted))):
+                if event:
+                    yield event
+                if sync_state:
+                    sync_state.update(self.label, self.uidvalidity, uid)
+        if sync_state and uids:
+            sync_state.update(self.label, self.uidvalidity, uids[-1])
+
+    def cache_key(self, uid: int) -> str:
+        return f'uid:{self.label}:{self.uidvalidity}:{uid}'
+
+    def uncached(self, cache, uids: list) -> list:
+        """
+        This function returns the UIDs whose emails are not in the ParseCache yet.
+        :param cache:
+        :param uids:
+        :return:
+        """
+        return [uid for uid in uids if self.cache_key(uid) not in cache]
+
+    def cached_events(self, cache, uids: list, missing: list, downloaded: dict, keep: set = frozenset()) -> list:
+        """
+        This function saves the emails that were downloaded in the ParseCache and returns
+        (uid, event or None) for every UID, in order. The missing UIDs that were not downloaded
+        are not from the sender. Nothing in 'keep' is pushed out of the cache to make room.
+        This should not be run alone.
+        :param cache:
+        :param uids:
+        :param missing:
+        :param downloaded:
+        :param keep:
+        :return:
+        """
+        missing = set(missing)
+        keys = {uid: self.cache_key(uid) for uid in uids}
+        # What was already cached is read before anything new is added, which could push it out.
+        records = {uid: cache.get(keys[uid]) for uid in uids if uid not in missing}
+        keep = set(keys.values()) | keep
+        for uid in uids:
+            if uid in downloaded:
+                records[uid] = cache.parse(downloaded[uid], keep)
+                cache.put(keys[uid], records[uid], keep)
+            elif uid in missing:
+                # Not from the sender, remembered so the headers are not looked at again either.
+                records[uid] = None
+                cache.put(keys[uid], None, keep)
+        return [(uid, Event.from_record(records[uid]) if records[uid] else None) for uid in uids]
+
+    def backfill(self, cache, uids: list, connections: int = 4, batch_size: int = 200, sender: str = None):
+        """
+        This function downloads a large number of messages, such as a whole label on first
+        setup or after its UIDVALIDITY changed, over several IMAP connections at once. The
+        UIDs are split into ranges of 'batch_size' and each connection logs in on its own and
+        downloads one range at a time. The ranges are handed back in order, as a list of their
+        UIDs and the events found in them, so the caller can save a checkpoint after any range.
+        Like iter_events emails already in the ParseCache are not downloaded again.
+        :param cache:
+        :param uids:
+        :param connections:
+        :param batch_size:
+        :param sender:
+        :return:
+        """
+        local = threading.local()
+        opened = []
+        lock = threading.Lock()
+
+        def download(chunk: list) -> list:
+            if not hasattr(local, 'gmail'):
+                local.gmail = Gmail(self.username, self.password, self.imap, self.port, self.timeout,
+                                    self.look_pretty, ssl=self.ssl)
+                with lock:
+                    opened.append(local.gmail)
+                local.gmail.set_label(self.label)
+                if local.gmail.uidvalidity != self.uidvalidity:
+                    raise imaplib.IMAP4.error(f'The UIDVALIDITY of {self.label} changed during the backfill.')
+            for attempt in range(2):
+                try:
+                    wanted = local.gmail.filter_sender(chunk, sender) if sender else chunk
+                    return local.gmail.fetch_messages(wanted)
+                except (imaplib.IMAP4.abort, OSError):
+                    # A dropped connection logs in again and tries the range once more.
+                    if attempt:
+                        raise
+                    local.gmail.reconnect()
+
+        def submit(chunk: list) -> None:
+            missing = self.uncached(cache, chunk)
+            running.append((chunk, missing, pool.submit(download, missing) if missing else None))
+
+        chunks = deque(uids[start:start + batch_size] for start in range(0, len(uids), batch_size))
+        running = deque()
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            try:
+                # Keeps a couple of ranges per connection downloading ahead of the one handed back.
+                while chunks and len(running) < connections * 2:
+                    submit(chunks.popleft())
+                while running:
+                    chunk, missing, future = running.popleft()
+                    if chunks:
+                        submit(chunks.popleft())
+                    downloaded = dict(future.result()) if future else {}
+                    # The ranges waiting their turn were found in the cache when they were started,
+                    # so they have to stay in it until then.
+                    waiting = {self.cache_key(uid) for later, _, _ in running for uid in later}
+                    found = self.cached_events(cache, chunk, missing, downloaded, waiting)
+                    yield chunk, [event for _, event in found if event]
+            finally:
+                # Stopping early only waits for the ranges that are already downloading.
+                for _, _, future in running:
+                    if future:
+                        future.cancel()
+                pool.shutdown(wait=True)
+                for gmail in opened:
+                    self.round_trips += gmail.round_trips
+                    self.bytes_received += gmail.bytes_received
+                    try:
+                        gmail.connection.logout()
+                    except Exception:
+                        pass
+
+    def search_uids(self, search: str = '(ALL)', after: int = 0) -> list:
+        """
+        This function returns the UIDs of the messages matching the search that are newer
+        than the UID provided, oldest first.
+        :param search:
+        :param after:
+        :return:
+        """
+        _, result = self.command('UID SEARCH', None, f'UID {after + 1}:*', search)
+        # A range ending in '*' always matches the newest message, even if it is older than 'after'.
+        return sorted(uid for uid in map(int, result[0].split()) if uid > after)
+
+    def filter_sender(self, uids: list, sender: str) -> list:
+        """
+        This function downloads only the headers of the messages provided and returns the
+        UIDs of the ones that were sent from the sender, this way the rest are never downloaded.
+        :param uids:
+        :param sender:
+        :return:
+        """
+        if not uids:
+            return []
+        _, data = self.command('UID FETCH', message_set(uids),
+                               '(UID BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)])')
+        wanted = []
+        for uid, header in fetched_messages(data):
+            if sender.lower() in str(BytesHeaderParser().parsebytes(header)['From']).lower():
+                wanted.append(uid)
+        return sorted(wanted)
+
+    def fetch_messages(self, uids: list, peek: bool = False) -> list:
+        """
+        This function downloads the full messages of the UIDs provided in a single request
+        and returns them as a list of (uid, raw message) oldest first. Peeking does not mark
+        the messages as read.
+        :param uids:
+        :param peek:
+        :return:
+        """
+        if not uids:
+            return []
+        _, data = self.command('UID FETCH', message_set(uids), '(UID BODY.PEEK[])' if peek else '(UID RFC822)')
+        return sorted(fetched_messages(data))
+
+    def command(self, name: str, *args):
+        """
+        This function sends an IMAP command and counts the round trip and the bytes that
+        came back. Names starting with 'UID ' are sent as UID commands.
+        :param name:
+        :param args:
+        :return:
+        """
+        start = perf_counter() if metrics.enabled else None
+        received = self.bytes_received
+        try:
+            if name.startswith('UID '):
+                typ, data = self.connection.uid(name[4:], *args)
+            else:
+                typ, data = getattr(self.connection, name.lower())(*args)
+        except Exception:
+            if start is not None:
+                metrics.observe('imap_' + name.lower().replace(' ', '_'), perf_counter() - start, error=True)
+            raise
+        self.round_trips += 1
+        for part in data or []:
+            if isinstance(part, tuple):
+                self.bytes_received += sum(len(p) for p in part)
+            elif part:
+                self.bytes_received += len(part)
+        if start is not None:
+            metrics.observe('imap_' + name.lower().replace(' ', '_'), perf_counter() - start)
+            metrics.count('imap_bytes_received', self.bytes_received - received)
+        return typ, data
+
+
+@instrument('parse_message')
+def message_text(message: bytes) -> str:
+    """
+    This function returns the plain text part of a raw email with the quoted-printable and
+    charset already decoded. BeautifulSoup is only used for emails without a plain text part.
+    :param message:
+    :return:
+    """
+    html = None
+    # The default compat32 policy is used on purpose, the modern policy is several times slower.
+    for part in email.message_from_bytes(message).walk():
+        if part.get_filename() or part.get_content_type() not in ('text/plain', 'text/html'):
+            continue
+        payload = part.get_payload(decode=True)
+        if payload is None:
+            continue
+        try:
+            text = payload.decode(part.get_content_charset() or 'utf-8', 'replace')
+        except LookupError:
+            text = payload.decode('utf-8', 'replace')
+        if part.get_content_type() == 'text/plain':
+            return text
+        html = html or text
+    from bs4 import BeautifulSoup
+    if html:
+        return BeautifulSoup(html, 'lxml').get_text('\n')
+    return BeautifulSoup(message, 'lxml').getText().replace('=E2=80=A2', '-').replace('=E2=80=99', '\'')
+
+
+def message_set(uids: list) -> str:
+    """
+    This function squeezes a list of UIDs into an IMAP message set such as '1:200,205'.
+    :param uids:
+    :return:
+    """
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and ranges[-1][1] + 1 == uid:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(low) if low == high else f'{low}:{high}' for low, high in ranges)
+
+
+def fetched_messages(data: list) -> list:
+    """
+    This function pulls the (uid, payload) pairs out of a FETCH response. Some servers send
+    the UID after the message itself so the line after the payload is checked as well.
+    :param data:
+    :return:
+    """
+    result = []
+    pending = None
+    for part in data:
+        if isinstance(part, tuple):
+            match = FETCH_UID.search(part[0])
+            if match:
+                result.append((int(match.group(1)), part[1]))
+                pending = None
+            else:
+                pending = part[1]
+        elif pending is not None and part:
+            match = FETCH_UID.search(part)
+            if match:
+                result.append((int(match.group(1)), pending))
+            pending = None
+    return result
+
+
+class SyncState:
+
+    def __init__(self, file: str = 'gmail_sync.json'):
+        self.file = file
+        self.load()
+
+    def load(self) -> None:
+        """
+        This function reads the sync state from disk, throwing away anything that was not saved.
+        A file that can not be read is treated as empty so every mailbox is synced again.
+        :return:
+        """
+        self.mailboxes = {}
+        if os.path.isfile(self.file):
+            try:
+                with open(self.file, 'r') as f:
+                    self.mailboxes = json.load(f)
+            except ValueError:
+                print(f'{self.file} could not be read, syncing every mailbox again.')
+
+    def last_uid(self, mailbox: str, uidvalidity: int) -> int:
+        """
+        This function returns the last UID that was synced for the mailbox. If the server
+        has changed the UIDVALIDITY of the mailbox the old UIDs mean nothing anymore so 0 is
+        returned and the whole mailbox will be synced again.
+        :param mailbox:
+        :param uidvalidity:
+        :return:
+        """
+        saved = self.mailboxes.get(mailbox)
+        if not saved or saved['uidvalidity'] != uidvalidity:
+            return 0
+        return saved['last_uid']
+
+    def update(self, mailbox: str, uidvalidity: int, last_uid: int) -> None:
+        """
+        This function records how far the mailbox has been synced.
+        :param mailbox:
+        :param uidvalidity:
+        :param last_uid:
+        :return:
+        """
+        self.mailboxes[mailbox] = {'uidvalidity': uidvalidity, 'last_uid': last_uid}
+
+    def save(self) -> None:
+        """
+        This function writes the sync state to disk. Only call this once the messages that
+        were synced have been saved to the database or they will be skipped next run.
+        :return:
+        """
+        write_atomically(self.file, json.dumps(self.mailboxes))
+
+
+class ParseCache:
+
+    def __init__(self, file: str = 'parse_cache.json', max_entries: int = 20000):
+        """
+        This remembers what was found in every email that has been parsed, either the fields
+        of its event or None if it was not an event, so an email is only ever parsed once.
+        Emails are looked up by their UID in a label and by their Message-ID, or a hash of the
+        whole email if it has none, so the same email is known even after its UID changes.
+        Only the 'max_entries' most recently used entries are kept.
+        :param file:
+        :param max_entries:
+        """
+        self.file = file
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if os.path.isfile(self.file):
+            try:
+                with open(self.file, 'r') as f:
+                    self.entries = OrderedDict(json.load(f))
+            except ValueError:
+                print(f'{self.file} could not be read, starting with an empty parse cache.')
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def get(self, key: str):
+        """
+        This function returns the fields saved under the key and marks them as recently used.
+        :param key:
+        :return:
+        """
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key: str, record, keep: set = frozenset()) -> None:
+        """
+        This function saves the fields of an event, or None for an email that is not one,
+        forgetting the least recently used entries once there are too many. The keys in
+        'keep', such as the rest of the emails being synced, are never the ones forgotten.
+        :param key:
+        :param record:
+        :param keep:
+        :return:
+        """
+        self.entries[key] = record
+        self.entries.move_to_end(key)
+        excess = len(self.entries) - self.max_entries
+        if excess > 0:
+            oldest = itertools.islice(self.entries, excess + len(keep))
+            for old in [old for old in oldest if old not in keep][:excess]:
+                del self.entries[old]
+
+    def parse(self, message: bytes, keep: set = frozenset()):
+        """
+        This function returns the fields of the event in a raw email, or None if it is not an
+        event, only parsing the email if it has not been seen before. Look at put for 'keep'.
+        :param message:
+        :param keep:
+        :return:
+        """
+        header = message[:message.find(b'\r\n\r\n') if b'\r\n\r\n' in message else message.find(b'\n\n')]
+        found = MESSAGE_ID.search(header)
+        key = 'id:' + (found.group(1).decode('ascii', 'replace') if found else hashlib.sha1(message).hexdigest())
+        if key in self.entries:
+            self.hits += 1
+            metrics.count('parse_cache_hits')
+            return self.get(key)
+        self.misses += 1
+        metrics.count('parse_cache_misses')
+        event = Event(message_text(message))
+        record = {name: getattr(event, name) for name in EVENT_FIELDS} if event.valid else None
+        self.put(key, record, keep)
+        return record
+
+    def save(self) -> None:
+        """
+        This function writes the cache to disk.
+        :return:
+        """
+        write_atomically(self.file, json.dumps(list(self.entries.items())))
+
+
+class SMTPPool:
+
+    def __init__(self, username: str, password: str, host: str = 'smtp.gmail.com', port: int = 465,
+                 workers: int = 2, queue_size: int = 100, ssl: bool = True):
+        """
+        This is a fixed group of workers that send queued messages. Each worker keeps one
+        logged in connection open for as many messages as it can and only reconnects after
+        an error. When the queue is full whoever is adding messages waits.
+        :param username:
+        :param password:
+        :param host:
+        :param port:
+        :param workers:
+        :param queue_size:
+        :param ssl:
+        """
+        self.username = username
+        self.password = password
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def connect(self) -> smtplib.SMTP:
+        """
+        This function opens and logs into a new connection. This should not be run alone.
+        :return:
+        """
+        smtp = (smtplib.SMTP_SSL if self.ssl else smtplib.SMTP)(self.host, self.port, timeout=30)
+        smtp.login(self.username, self.password)
+        return smtp
+
+    def submit(self, msg, retries: int = 1) -> Future:
+        """
+        This function queues a message and returns a future that becomes True once the
+        message has been handed to the server, or holds the error if it could not be sent.
+        :param msg:
+        :param retries:
+        :return:
+        """
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        future = Future()
+        self.queue.put((msg, future, retries))
+        return future
+
+    def work(self) -> None:
+        """
+        This function is what each worker runs. This should not be run alone.
+        :return:
+        """
+        smtp = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            msg, future, retries = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            for attempt in range(retries + 1):
+                try:
+                    if smtp is None:
+                        smtp = self.connect()
+                    start = perf_counter()
+                    smtp.send_message(msg)
+                    if metrics.enabled:
+                        metrics.observe('smtp_send', perf_counter() - start)
+                    future.set_result(True)
+                    break
+                except Exception as e:
+                    metrics.count('smtp_errors')
+                    # The connection may have timed out or been dropped, start over with a new one.
+                    try:
+                        smtp.close()
+                    except Exception:
+                        pass
+                    smtp = None
+                    if attempt == retries:
+                        future.set_exception(e)
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except Exception:
+                pass
+
+    def close(self) -> None:
+        """
+        This function waits for every queued message to be sent and then stops the workers.
+        :return:
+        """
+        with self.lock:
+            for _ in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+
+
+def load_attachment(path: str) -> MIMEPart:
+    """
+    This function returns an image file ready to be attached to emails. The file is read,
+    its type worked out and its contents encoded only once, the same part is then attached
+    to every email it is sent with. It is read again if the file changes.
+    :param path:
+    :return:
+    """
+    return attachment_part(path, os.path.getmtime(path))
+
+
+@functools.lru_cache(maxsize=32)
+def attachment_part(path: str, modified: float) -> MIMEPart:
+    """
+    This function reads and encodes an attachment. Use load_attachment instead.
+    :param path:
+    :param modified:
+    :return:
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    part = MIMEPart()
+    part.set_content(data, maintype='image', subtype=imghdr.what(None, data), filename=path)
+    return part
+
+
+class CarrierResolver:
+
+    def __init__(self, gateways: list, file: str = 'carriers.json'):
+        """
+        This remembers which email to text gateway reaches each phone number so a text only
+        has to be sent to every gateway the first time. Gateways are learned from the bounces
+        of the ones that did not work and from replies sent back through the one that did, or
+        can be written into the file by hand as {"5551234567": {"gateway": "@tmomail.net"}}.
+        :param gateways:
+        :param file:
+        """
+        self.gateways = list(gateways)
+        self.file = file
+        self.lock = threading.Lock()
+        self.numbers = {}
+        if os.path.isfile(self.file):
+            try:
+                with open(self.file, 'r') as f:
+                    self.numbers = json.load(f)
+            except ValueError:
+                print(f'{self.file} could not be read, every number will be sent to all gateways.')
+
+    def lookup(self, number: str) -> list:
+        """
+        This function returns the gateways to send a text to, just the known one or every
+        gateway that has not bounced for this number yet.
+        :param number:
+        :return:
+        """
+        with self.lock:
+            known = self.numbers.get(number, {})
+            if known.get('gateway'):
+                return [known['gateway']]
+            untried = [gateway for gateway in self.gateways if gateway not in known.get('bounced', [])]
+            return untried or list(self.gateways)
+
+    def pending(self) -> bool:
+        """
+        This function checks if any number is still waiting to find out its gateway.
+        :return:
+        """
+        with self.lock:
+            return any(not known.get('gateway') for known in self.numbers.values())
+
+    def sent(self, number: str) -> None:
+        with self.lock:
+            self.numbers.setdefault(number, {'gateway': None, 'bounced': []})
+
+    def confirm(self, number: str, gateway: str) -> None:
+        """
+        This function saves the gateway that reaches a number.
+        :param number:
+        :param gateway:
+        :return:
+        """
+        with self.lock:
+            self.numbers[number] = {'gateway': gateway, 'bounced': []}
+
+    def bounced(self, number: str, gateway: str) -> None:
+        """
+        This function writes down that a gateway does not reach a number. Once every gateway
+        but one has bounced the one left must be the right one. If the known gateway bounces
+        the number has changed carrier and it is looked for again.
+        :param number:
+        :param gateway:
+        :return:
+        """
+        with self.lock:
+            known = self.numbers.setdefault(number, {'gateway': None, 'bounced': []})
+            if known['gateway'] == gateway:
+                known['gateway'] = None
+                known['bounced'] = []
+            if gateway not in known['bounced']:
+                known['bounced'].append(gateway)
+            left = [gateway for gateway in self.gateways if gateway not in known['bounced']]
+            if len(left) == 1:
+                known['gateway'] = left[0]
+            elif not left:
+                # Every gateway bounced, everything is tried again next time.
+                known['bounced'] = []
+
+    def search(self) -> str:
+        """
+        This function returns the IMAP search for bounces and for replies sent through a gateway.
+        :return:
+        """
+        senders = ['mailer-daemon'] + [gateway[1:] for gateway in self.gateways]
+        query = f'FROM "{senders[-1]}"'
+        for sender in reversed(senders[:-1]):
+            query = f'OR FROM "{sender}" {query}'
+        return f'({query})'
+
+    def learn(self, message: bytes) -> None:
+        """
+        This function learns from a raw email found with search. A bounce marks every gateway
+        address in it as not working and a reply from a gateway address confirms it.
+        :param message:
+        :return:
+        """
+        sender = parseaddr(str(BytesHeaderParser().parsebytes(message)['From']))[1].lower()
+        number, _, domain = sender.partition('@')
+        if number in ('mailer-daemon', 'postmaster'):
+            for recipient, gateway in set(GATEWAY_ADDRESS.findall(message)):
+                gateway = gateway.decode().lower()
+                if gateway in self.gateways:
+                    self.bounced(recipient.decode(), gateway)
+        elif number.isdigit() and '@' + domain in self.gateways:
+            self.confirm(number, '@' + domain)
+
+    def save(self) -> None:
+        with self.lock:
+            write_atomically(self.file, json.dumps(self.numbers, indent=4))
+
+
+def learn_carriers(gmail: Gmail, carriers: CarrierResolver, sync_state: SyncState, label: str = 'INBOX') -> int:
+    """
+    This function reads the bounces and text replies that arrived in the label since last
+    time and saves what was learned about each number's gateway. It does nothing while no
+    number is waiting to find its gateway. It returns how many emails were read.
+    :param gmail:
+    :param carriers:
+    :param sync_state:
+    :param label:
+    :return:
+    """
+    if not carriers.pending():
+        return 0
+    previous = gmail.label
+    gmail.set_label(label)
+    try:
+        uids = gmail.search_uids(carriers.search(), sync_state.last_uid(label, gmail.uidvalidity))
+        for start in range(0, len(uids), 50):
+            # Peeking leaves the bounces unread in the inbox.
+            for uid, message in gmail.fetch_messages(uids[start:start + 50], peek=True):
+                carriers.learn(message)
+        if uids:
+            sync_state.update(label, gmail.uidvalidity, uids[-1])
+    finally:
+        if previous:
+            gmail.set_label(previous)
+    carriers.save()
+    sync_state.save()
+    return len(uids)
 
 
 class Alert:
 
-    def __init__(self, username, password):
+    def __init__(self, username, password, host: str = 'smtp.gmail.com', port: int = 465, workers: int = 2,
+                 queue_size: int = 100, ssl: bool = True, carriers: CarrierResolver = None,
+                 carriers_file: str = 'carriers.json'):
         self.username = username
         self.password = password
+        self.pool = SMTPPool(username, password, host, port, workers, queue_size, ssl)
         self.MMS = [
             '@mms.att.net',  # at&t/Cricket
             '@tmomail.net',  # T-Mobile
@@ -97,6 +1143,8 @@ class Alert:
             # '@msg.fi.google.com',  # Google Fi
             '@mmst5.tracfone.com'  # Tracfone
         ]
+        # Remembers which of the gateways above reaches each number, see learn_carriers.
+        self.carriers = carriers or CarrierResolver(self.MMS, carriers_file)
 
     def SendAlert(self, Receiver: str, Message: str, Subject: str = None, Image: str = None,
                   From: str = None):
@@ -110,13 +1158,15 @@ class Alert:
         :return:
         """
         if Receiver.find('@') != -1:
-            self.Email(Receiver, Message, Subject, Image, From)
+            return self.Email(Receiver, Message, Subject, Image, From)
         else:
-            self.Text(Receiver, Message, Subject, Image, From)
+            return self.Text(Receiver, Message, Subject, Image, From)
 
     def Text(self, Receiver: str, Message: str, Subject: str = None, Image: str = None, From: str = None):
         """
-        This function takes a phone number and sends it a message from an email.
+        This function takes a phone number and sends it a message from an email. Numbers whose
+        carrier is known only get one email, the rest are sent through every gateway that has
+        not bounced for them. It returns a list of futures, one for each gateway used.
         :param Receiver:
         :param Message:
         :param Subject:
@@ -124,29 +1174,21 @@ class Alert:
         :param From:
         :return:
         """
-        Messages = []
-        for Provider in self.MMS:
-            msg = EmailMessage()
-            msg['Subject'] = Subject
-            msg['From'] = From
-            msg['To'] = Receiver + Provider
-            msg.set_content(Message)
-
-            if Image:
-                with open(Image, 'rb') as f:
-                    file_data = f.read()
-                    file_type = imghdr.what(f.name)
-                    file_name = f.name
-                msg.add_attachment(file_data, maintype='image', subtype=file_type, filename=file_name)
-            Messages.append(msg)
-
-        for m in Messages:
-            threading.Thread(target=self.Send, args=(m,)).start()
+        number = re.sub(r'\D', '', Receiver)
+        gateways = self.carriers.lookup(number)
+        if len(gateways) > 1:
+            self.carriers.sent(number)
+            self.carriers.save()
+        metrics.count('texts_sent_to_all_gateways' if len(gateways) > 1 else 'texts_sent_to_known_gateway')
+        attachment = load_attachment(Image) if Image else None
+        return [self.pool.submit(self.Build(number + Provider, Message, Subject, attachment, From))
+                for Provider in gateways]
 
     def Email(self, Receiver: str, Message: str, Subject: str = None, Image: str = None, From: str = None,
               Cc: str = None):
         """
-        This function sends an email. Passing a From argument can mask your email address.
+        This function sends an email. Passing a From argument can mask your email address. It
+        returns a future that becomes True once the email has been sent.
         :param Cc:
         :param Receiver:
         :param Message:
@@ -155,30 +1197,47 @@ class Alert:
         :param From:
         :return:
         """
+        attachment = load_attachment(Image) if Image else None
+        return self.pool.submit(self.Build(Receiver, Message, Subject, attachment, From, Cc))
+
+    def Build(self, Receiver: str, Message: str, Subject: str = None, Attachment: MIMEPart = None,
+              From: str = None, Cc: str = None) -> EmailMessage:
+        """
+        This function puts together an email. The attachment is a part from load_attachment
+        which is shared with every other email it is attached to instead of being copied.
+        :param Receiver:
+        :param Message:
+        :param Subject:
+        :param Attachment:
+        :param From:
+        :param Cc:
+        :return:
+        """
         msg = EmailMessage()
         msg['Subject'] = Subject
-        msg['From'] = From
+        # Empty headers are left out, otherwise they are sent as 'None' and smtplib even tries
+        # to deliver a copy to a 'None' Cc.
+        if From:
+            msg['From'] = From
         msg['To'] = Receiver
-        msg['Cc'] = Cc
+        if Cc:
+            msg['Cc'] = Cc
         msg.set_content(Message)
+        if Attachment is not None:
+            msg.make_mixed()
+            msg.attach(Attachment)
+        return msg
 
-        if Image:
-            with open(Image, 'rb') as f:
-                file_data = f.read()
-                file_type = imghdr.what(f.name)
-                file_name = f.name
-            msg.add_attachment(file_data, maintype='image', subtype=file_type, filename=file_name)
-        threading.Thread(target=self.Send, args=(msg,)).start()
-
+    @instrument('smtp_send_direct')
     def Send(self, msg):
         """
-        This function sends any messages that have been compiled by the functions above. This should
-        not be run alone.
+        This function sends a single message right away over its own connection. The functions
+        above queue their messages on the pool instead.
         :param msg:
         :return:
         """
         try:
-            with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp:
+            with (smtplib.SMTP_SSL if self.pool.ssl else smtplib.SMTP)(self.pool.host, self.pool.port) as smtp:
                 smtp.login(self.username, self.password)
                 smtp.send_message(msg)
             return True
@@ -186,22 +1245,118 @@ class Alert:
             print(e)
             return False
 
+    def close(self) -> None:
+        """
+        This function waits for every queued message to be sent.
+        :return:
+        """
+        self.pool.close()
+
+
+class RateLimiter:
+
+    def __init__(self, rate: float, capacity: int = None):
+        """
+        This is a token bucket, it lets 'rate' calls through per second on average with
+        bursts of up to 'capacity' calls. It is safe to share between threads.
+        :param rate:
+        :param capacity:
+        """
+        self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        This function waits until a call is allowed through.
+        :return:
+        """
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """
+        This function stops every caller for the amount of seconds provided, this is used
+        when the server says we are going too fast.
+        :param seconds:
+        :return:
+        """
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+def retry_after_seconds(value: str, default: float = 1) -> float:
+    """
+    This function reads a Retry-After header, which is either a number of seconds or a date.
+    :param value:
+    :param default:
+    :return:
+    """
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return default
+
 
 class Zoom:
 
-    def __init__(self, key: str, secret: str):
+    def __init__(self, key: str, secret: str, rate: float = 10, retries: int = 3,
+                 api: str = 'https://api.zoom.us/v2', limiter: RateLimiter = None, session=None):
         self.key = key
         self.secret = secret
+        self.api = api
+        self.retries = retries
+        # One session keeps the connection to zoom open between requests, it is made on first use
+        # unless one is passed in to share with other Zoom objects, the same goes for the limiter.
+        self.session = session
+        self.limiter = limiter or RateLimiter(rate)
+        self.token = None
+        self.token_expires = 0
+        self.token_lock = threading.Lock()
+
+    def create_auth_token(self, algorithm: str = 'HS256', lifetime: int = 5000) -> str:
+        """
+        This function generates a javascript token with the zoom key and secret. The same
+        token is handed out until it is a minute away from expiring. This should not be run alone.
+        :param algorithm:
+        :param lifetime:
+        :return:
+        """
+        with self.token_lock:
+            if self.token is None or self.token_expires - time() < 60:
+                self.renew_auth_token(algorithm, lifetime)
+            return self.token
 
-    def create_auth_token(self, algorithm: str = 'HS256') -> jwt.encode:
+    def renew_auth_token(self, algorithm: str = 'HS256', lifetime: int = 5000) -> tuple:
         """
-        This function generates a javascript token with the zoom key and secret. This should
-        not be run alone.
+        This function generates a new token right away and returns (token, expiry time).
         :param algorithm:
+        :param lifetime:
         :return:
         """
-        return jwt.encode({'iss': self.key, 'exp': time() + 5000}, self.secret, algorithm=algorithm)
+        import jwt
+        expires = time() + lifetime
+        self.token = jwt.encode({'iss': self.key, 'exp': expires}, self.secret, algorithm=algorithm)
+        self.token_expires = expires
+        return self.token, expires
 
+    @instrument('zoom_create_meeting')
     def create_meeting(self, data, duration: str = '60', timezone: str = 'America/Los_Angeles') -> dict:
         """
         This function takes a event object and creates a zoom link with the data within. If you wish
@@ -212,7 +1367,6 @@ class Zoom:
         :param timezone:
         :return:
         """
-        token = self.create_auth_token()
         meeting_details = {'topic': f'Tutoring Session With {data.invitee}',
                            'type': 2,
                            'start_time': f"{data.date}T{data.time}Z",
@@ -223,31 +1377,92 @@ class Zoom:
                                         'waiting_room': 'true',
                                         }
                            }
-        headers = {'authorization': f'Bearer {token}',
-                   'content-type': 'application/json'}
-        r = requests.post(f'https://api.zoom.us/v2/users/me/meetings', headers=headers,
-                          data=json.dumps(meeting_details))
+        if self.session is None:
+            import requests
+            with self.token_lock:
+                self.session = self.session or requests.Session()
+        for _ in range(self.retries + 1):
+            self.limiter.acquire()
+            headers = {'authorization': f'Bearer {self.create_auth_token()}',
+                       'content-type': 'application/json'}
+            r = self.session.post(f'{self.api}/users/me/meetings', headers=headers,
+                                  data=json.dumps(meeting_details), timeout=30)
+            if r.status_code != 429:
+                break
+            # Too many requests, everyone waits for as long as zoom asks before trying again.
+            metrics.count('zoom_rate_limited')
+            self.limiter.pause(retry_after_seconds(r.headers.get('Retry-After')))
         return json.loads(r.text)
 
 
-class Event:
+class EventBase:
+    # Slots keep every event small, the date and time are parsed once when they are set.
+    __slots__ = ('valid', 'invitee', 'invitee_email', 'invitee_timezone', 'notified', 'zoom_id',
+                 'zoom_join_url', 'zoom_passcode', '_date', '_time', '_day', '_clock')
 
-    def __init__(self, message: str):
-        scraped = self.scrap_info(message)
-        if not scraped:
-            self.valid = False
-        else:
-            self.valid = True
-            self.invitee = scraped['Invitee']
-            self.invitee_email = scraped['Invitee Email']
-            self.invitee_timezone = scraped['Invitee Time Zone']
-            self.time = scraped['Time']
-            self.date = scraped['Date']
-            self.notified = False
-            self.zoom_id = None
-            self.zoom_join_url = None
-            self.zoom_passcode = None
-        del scraped
+    @classmethod
+    def from_record(cls, record: dict):
+        """
+        This function rebuilds a saved event from a dictionary of its fields without
+        needing the email it came from.
+        :param record:
+        :return:
+        """
+        event = cls.__new__(cls)
+        event.valid = True
+        for name in EVENT_FIELDS:
+            setattr(event, name, record.get(name))
+        event.notified = bool(event.notified)
+        return event
+
+    def __getstate__(self):
+        """
+        This function saves the event as the same dictionary events were saved as before they
+        used slots, so old and new files can be read either way.
+        :return:
+        """
+        state = {'valid': self.valid}
+        if self.valid:
+            for name in EVENT_FIELDS:
+                state[name] = getattr(self, name, None)
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **(state[1] or {})}
+        for name, value in state.items():
+            try:
+                setattr(self, name, value)
+            except AttributeError:
+                # Fields that no longer exist are dropped.
+                pass
+
+    @property
+    def date(self) -> str:
+        return self._date
+
+    @date.setter
+    def date(self, value: str):
+        try:
+            day = datetime.date.fromisoformat(value)
+        except ValueError:
+            year, month, day = value.split('-')
+            day = datetime.date(int(year), int(month), int(day))
+        self._date = value
+        self._day = day
+
+    @property
+    def time(self) -> str:
+        return self._time
+
+    @time.setter
+    def time(self, value: str):
+        try:
+            clock = datetime.time.fromisoformat(value)
+        except ValueError:
+            clock = datetime.datetime.strptime(value, '%H:%M:%S').time()
+        self._time = value
+        self._clock = clock
 
     def __str__(self):
         """
@@ -265,68 +1480,34 @@ class Event:
                f'Zoom Passcode: {self.zoom_passcode}\n' \
                f'Notified: {str(self.notified)}'
 
-    def scrap_info(self, text: str, start: str = 'Event Type:', end: str = 'View event in Calendly'):
-        """
-        This function takes the raw data of the emails and converts it into data we can use. This
-        should not be run alone.
-        :param text:
-        :param start:
-        :param end:
-        :return:
-        """
-        if start not in text and end not in text:
-            return None
-        months = {'january': '01', 'february': '02', 'march': '03', 'april': '04', 'may': '05', 'june': '06',
-                  'july': '07',
-                  'august': '08', 'september': '09', 'october': '10', 'november': '11', 'december': '12'}
-        result = {}
-        updated = '\n'.join([m.rstrip('=') for m in text.split('\r\n')])
-        updated = updated[updated.find(start):updated.find(end) + len(end)].split('\n')
-        for i, entry in enumerate(updated):
-            if 'Invitee:' in entry:
-                result['Invitee'] = updated[i + 1]
-            if 'Invitee Email:' in entry:
-                result['Invitee Email'] = updated[i + 1]
-            if 'Event Date/Time' in entry:
-                mtime = updated[i + 1].split('-')[0].strip()
-                result['Time'] = str(int(mtime[:2]) + 12) + mtime[2:5] + ':00' if 'pm' in mtime and mtime[:2] != '12' \
-                    else mtime[:5] + ':00'
-                date = updated[i + 1].split(',')[1].split('(')[0].strip().split()
-                date[0] = '0' + date[0] if len(date[0]) == 1 else date[0]
-                result['Date'] = date[2] + '-' + months[date[1].lower()] + '-' + date[0]
-            if 'Invitee Time Zone:' in entry:
-                result['Invitee Time Zone'] = updated[i + 1].split('-')[0].strip()
-        return result
-
     def convert_date(self) -> datetime.date:
         """
-        This function converts the string date to a datetime.date object so it can
+        This function returns the date as a datetime.date object so it can
         be compared to other datetime.date objects.
         :return:
         """
-        event_date = self.date.split('-')
-        return datetime.datetime(int(event_date[0]), int(event_date[1]), int(event_date[2])).date()
+        return self._day
 
     def get_day_of_week(self) -> str:
         """
         This function converts the date of the event to the day of the week.
         :return:
         """
-        return self.convert_date().strftime('%A')
+        return self._day.strftime('%A')
 
     def get_month(self) -> str:
         """
         This function converts the date of the event to a month of the year.
         :return:
         """
-        return self.convert_date().strftime('%B')
+        return self._day.strftime('%B')
 
     def get_suffix(self) -> str:
         """
         This function return the day with a suffix appended to it.
         :return:
         """
-        day = self.convert_date().day
+        day = self._day.day
         suffix = 'th' if 11 <= day <= 13 else {1: 'st', 2: 'nd', 3: 'rd'}.get(day % 10, 'th')
         return str(day) + suffix
 
@@ -335,25 +1516,115 @@ class Event:
         This function converts military time back to standard time.
         :return:
         """
-        return datetime.datetime.strptime(self.time, '%H:%M:%S').strftime('%I:%M %p')
+        return self._clock.strftime('%I:%M %p')
 
     def end_time(self):
-        return (datetime.datetime.strptime(self.time, '%H:%M:%S') + datetime.timedelta(minutes=50)).time()
+        return (datetime.datetime.combine(self._day, self._clock) + datetime.timedelta(minutes=50)).time()
+
+
+class Event(EventBase):
+    __slots__ = ()
+
+    def __init__(self, message: str):
+        scraped = self.scrap_info(message)
+        if not scraped:
+            self.valid = False
+        else:
+            self.valid = True
+            self.invitee = scraped['Invitee']
+            self.invitee_email = scraped['Invitee Email']
+            self.invitee_timezone = scraped['Invitee Time Zone']
+            self.time = scraped['Time']
+            self.date = scraped['Date']
+            self.notified = False
+            self.zoom_id = None
+            self.zoom_join_url = None
+            self.zoom_passcode = None
+        del scraped
+
+    @instrument('scrap_info')
+    def scrap_info(self, text: str, start: str = 'Event Type:', end: str = 'View event in Calendly'):
+        """
+        This function takes the text of the emails and converts it into data we can use. This
+        should not be run alone.
+        :param text:
+        :param start:
+        :param end:
+        :return:
+        """
+        if start not in text and end not in text:
+            return None
+        if '\r' in text:
+            # Text rendered from the raw email still has its quoted-printable line endings.
+            text = '\n'.join([m.rstrip('=') for m in text.split('\r\n')])
+        text = text[text.find(start):text.find(end) + len(end)]
+        fields = {}
+        for field in CALENDLY_FIELD.finditer(text):
+            fields.setdefault(field.group(1), field.group(2))
+        if len(fields) < 4:
+            return None
+        when = CALENDLY_WHEN.search(fields['Event Date/Time'])
+        if not when or when.group(5).lower() not in MONTHS:
+            return None
+        hour, minute, meridiem, day, month, year = when.groups()
+        hour = int(hour) + 12 if meridiem.lower() == 'pm' and hour != '12' else int(hour)
+        return {'Invitee': fields['Invitee'],
+                'Invitee Email': fields['Invitee Email'],
+                'Time': f'{hour:02}:{minute}:00',
+                'Date': f'{year}-{MONTHS[month.lower()]}-{int(day):02}',
+                'Invitee Time Zone': fields['Invitee Time Zone'].split('-')[0].strip()}
 
 
 class Calendar:
 
-    def __init__(self, email: str, user_file: str = 'calendar_auth.json'):
+    def __init__(self, email: str, user_file: str = 'calendar_auth.json',
+                 discovery_file: str = 'calendar_discovery.json'):
         self.user_file = user_file
-        self.user = self.login()
+        self.discovery_file = discovery_file
+        self.service = None
+        self.cred = None
+        self.lock = threading.RLock()
         self.user_email = email
 
+    @property
+    def user(self):
+        """
+        This is the google calendar service, it logs in the first time it is used so creating
+        a Calendar is instant.
+        :return:
+        """
+        with self.lock:
+            if self.service is None:
+                self.service = self.login()
+            return self.service
+
+    def refresh_login(self) -> tuple:
+        """
+        This function logs in if that has not happened yet, otherwise it refreshes the
+        credentials so they are not about to expire. It returns (access token, expiry time).
+        :return:
+        """
+        from google.auth.transport.requests import Request
+        service = self.user
+        if self.cred.refresh_token and (not self.cred.valid or not self.cred.expiry or
+                                        self.cred.expiry - datetime.datetime.utcnow() < datetime.timedelta(minutes=5)):
+            with self.lock:
+                self.cred.refresh(Request())
+                with open(self.user_file, 'w') as f:
+                    f.write(self.cred.to_json())
+        expiry = self.cred.expiry.replace(tzinfo=datetime.timezone.utc).timestamp() if self.cred.expiry else None
+        return service, expiry
+
+    @instrument('calendar_login')
     def login(self):
         """
         This function will check for credentials and create new ones if there are none
         on file.
         :return:
         """
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
         cred = None
         scopes = ['https://www.googleapis.com/auth/calendar']
         if os.path.isfile(self.user_file):
@@ -367,16 +1638,44 @@ class Calendar:
             with open(self.user_file, 'w') as f:
                 f.write(cred.to_json())
 
-        return build('calendar', 'v3', credentials=cred)
+        self.cred = cred
+        return self.build_service(cred)
 
-    def add_calendar_event(self, data, timezone: str = 'America/Los_Angeles'):
+    def build_service(self, cred):
         """
-        This function creates the google calendar events.
+        This function builds the google calendar service from the discovery document saved
+        on file so it does not have to be looked up every time, the first time it is saved.
+        Each thread sends its requests over its own connection since httplib2 is not thread
+        safe and the pipeline adds calendar events from several workers.
+        :param cred:
+        :return:
+        """
+        from googleapiclient.discovery import build, build_from_document
+        from googleapiclient.http import HttpRequest
+        import google_auth_httplib2
+        import httplib2
+        connections = threading.local()
+
+        def request_builder(http, *args, **kwargs):
+            if not hasattr(connections, 'http'):
+                connections.http = google_auth_httplib2.AuthorizedHttp(cred, http=httplib2.Http())
+            return HttpRequest(connections.http, *args, **kwargs)
+
+        if os.path.isfile(self.discovery_file):
+            with open(self.discovery_file, 'r') as f:
+                return build_from_document(f.read(), credentials=cred, requestBuilder=request_builder)
+        service = build('calendar', 'v3', credentials=cred, requestBuilder=request_builder)
+        write_atomically(self.discovery_file, json.dumps(service._rootDesc))
+        return service
+
+    def event_body(self, data, timezone: str = 'America/Los_Angeles') -> dict:
+        """
+        This function builds the google calendar event for an event object.
         :param data:
         :param timezone:
         :return:
         """
-        event = {
+        return {
             'summary': f'Tutoring Event With {data.invitee}!',
             'description': f'Meeting with {data.invitee}.\n'
                            f'Email Address: {data.invitee_email}\n'
@@ -395,14 +1694,220 @@ class Calendar:
                 {'email': self.user_email}
             ]
         }
-        self.user.events().insert(calendarId='primary', body=event).execute()
+
+    @instrument('calendar_insert')
+    def add_calendar_event(self, data, timezone: str = 'America/Los_Angeles'):
+        """
+        This function creates the google calendar events.
+        :param data:
+        :param timezone:
+        :return:
+        """
+        self.user.events().insert(calendarId='primary', body=self.event_body(data, timezone)).execute()
+
+    @instrument('calendar_batch')
+    def add_calendar_events(self, events: list, timezone: str = 'America/Los_Angeles', batch_size: int = 50) -> list:
+        """
+        This function creates many google calendar events using batch requests of up to 50
+        events each (the most google allows). It returns a list with None for every event
+        that was added or the error for every event that was not, in the same order.
+        :param events:
+        :param timezone:
+        :param batch_size:
+        :return:
+        """
+        results = [None] * len(events)
+
+        def callback(request_id, response, exception):
+            results[int(request_id)] = exception
+
+        for start in range(0, len(events), batch_size):
+            batch = self.user.new_batch_http_request(callback=callback)
+            for count in range(start, min(start + batch_size, len(events))):
+                batch.add(self.user.events().insert(calendarId='primary',
+                                                    body=self.event_body(events[count], timezone)),
+                          request_id=str(count))
+            try:
+                batch.execute()
+            except Exception as e:
+                for count in range(start, min(start + batch_size, len(events))):
+                    results[count] = e
+        return results
+
+
+class Archive:
+
+    def __init__(self, folder: str = 'archive', cached_months: int = 12):
+        """
+        This keeps the events that have passed out of the database in one compressed file per
+        month, such as archive/2021-09.jsonl.gz with one event per line. Files are only added
+        to and a month is only read when something asks for a date in it, the last
+        'cached_months' months read are kept in memory.
+        :param folder:
+        :param cached_months:
+        """
+        self.folder = folder
+        self.cached_months = cached_months
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def segment(self, month: str) -> str:
+        return os.path.join(self.folder, f'{month}.jsonl.gz')
+
+    def months(self) -> list:
+        """
+        This function returns every month that has archived events, oldest first.
+        :return:
+        """
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(name[:-len('.jsonl.gz')] for name in os.listdir(self.folder) if name.endswith('.jsonl.gz'))
+
+    def append(self, events: list) -> int:
+        """
+        This function adds the events to the file of their month. Each call adds a new gzip
+        member to the end of the file so nothing already written is touched.
+        :param events:
+        :return:
+        """
+        by_month = {}
+        for event in events:
+            by_month.setdefault(event.date[:7], []).append(event)
+        os.makedirs(self.folder, exist_ok=True)
+        with self.lock:
+            for month, archived in by_month.items():
+                with gzip.open(self.segment(month), 'at', encoding='utf-8') as f:
+                    for event in archived:
+                        f.write(json.dumps({name: getattr(event, name) for name in EVENT_FIELDS}) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+                self.cache.pop(month, None)
+        return len(events)
+
+    def load(self, month: str) -> dict:
+        """
+        This function returns the archived events of a month grouped by date. An event that
+        was archived twice, by a cleanup that crashed before it finished, is only kept once.
+        :param month:
+        :return:
+        """
+        path = self.segment(month)
+        if not os.path.isfile(path):
+            return {}
+        modified = os.path.getmtime(path)
+        with self.lock:
+            if month in self.cache and self.cache[month][0] == modified:
+                self.cache.move_to_end(month)
+                return self.cache[month][1]
+        events = {}
+        complete = True
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    event = Event.from_record(json.loads(line))
+                    events[(event.invitee, event.date, event.time)] = event
+        except (EOFError, OSError, ValueError):
+            # The file is being added to right now, what was read is used but not kept.
+            complete = False
+        by_date = {}
+        for event in events.values():
+            by_date.setdefault(event.date, []).append(event)
+        for day in by_date.values():
+            day.sort(key=lambda event: event.time)
+        if complete:
+            with self.lock:
+                self.cache[month] = (modified, by_date)
+                while len(self.cache) > self.cached_months:
+                    self.cache.popitem(last=False)
+        return by_date
+
+    def events_on_date(self, date: datetime.date) -> list:
+        """
+        This function returns the archived events on the specified date.
+        :param date:
+        :return:
+        """
+        return list(self.load(str(date)[:7]).get(str(date), []))
 
 
 class Database:
 
+    # Where cleanup moves past events to, nothing is kept if there is none.
+    archive = None
+
     def __init__(self):
         self.event_data = []
         self.last_clean_up = datetime.date.today()
+        self.reindex()
+
+    def __getstate__(self):
+        """
+        This function leaves the lookup tables out of the saved file, they are rebuilt when
+        the database is opened so older files without them still load.
+        :return:
+        """
+        state = self.__dict__.copy()
+        for name in ('by_key', 'by_date', 'dates', 'archive'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reindex()
+
+    def reindex(self) -> None:
+        """
+        This function rebuilds the lookup tables from event_data. The tables find an event
+        by its (invitee, date, time) and list events by date without looking at every event.
+        Call this if event_data is ever changed directly.
+        :return:
+        """
+        self.by_key = {}
+        self.by_date = {}
+        self.dates = []
+        for event in self.event_data:
+            self.index_event(event)
+
+    def index_event(self, event) -> None:
+        """
+        This function adds an event to the lookup tables. This should not be run alone.
+        :param event:
+        :return:
+        """
+        self.by_key[(event.invitee, event.date, event.time)] = event
+        date = event.convert_date()
+        if date not in self.by_date:
+            self.by_date[date] = []
+            bisect.insort(self.dates, date)
+        self.by_date[date].append(event)
+
+    def unindex_event(self, event) -> None:
+        """
+        This function removes an event from the lookup tables. This should not be run alone.
+        :param event:
+        :return:
+        """
+        key = (event.invitee, event.date, event.time)
+        if self.by_key.get(key) is event:
+            del self.by_key[key]
+        date = event.convert_date()
+        bucket = self.by_date.get(date, [])
+        for count, saved in enumerate(bucket):
+            if saved is event:
+                del bucket[count]
+                break
+        if date in self.by_date and not bucket:
+            del self.by_date[date]
+            del self.dates[bisect.bisect_left(self.dates, date)]
+
+    def store_event(self, event) -> None:
+        """
+        This function saves an event that has been fully prepared. This should not be run alone.
+        :param event:
+        :return:
+        """
+        self.event_data.append(event)
+        self.index_event(event)
 
     def append_event(self, event, zoom: Zoom, calendar, outdated_ok: bool = False) -> bool:
         """
@@ -429,7 +1934,7 @@ class Database:
         # This is the line that adds google calendar events.
         calendar.add_calendar_event(event)
         print(f'{event.invitee} has been scheduled for {event.get_month()} {event.get_suffix()}.')
-        self.event_data.append(event)
+        self.store_event(event)
         return True
 
     def event_saved(self, questioned) -> bool:
@@ -439,24 +1944,54 @@ class Database:
         :param questioned:
         :return:
         """
-        for event in self.event_data:
-            if (event.invitee, event.date, event.time) == \
-                    (questioned.invitee, questioned.date, questioned.time):
-                return True
-        return False
+        return (questioned.invitee, questioned.date, questioned.time) in self.by_key
 
     def events_on_date(self, date: datetime.date) -> list:
         """
-        This function returns any events that are happening on the specified date.
+        This function returns any events that are happening on the specified date. Dates
+        from before the last cleanup are looked up in the archive too.
         :param date:
         :return:
         """
+        return self.with_archived(date, list(self.by_date.get(date, [])))
+
+    def with_archived(self, date: datetime.date, events: list) -> list:
+        """
+        This function adds the archived events on a date that has been cleaned up to the
+        events still in the database. This should not be run alone.
+        :param date:
+        :param events:
+        :return:
+        """
+        if self.archive is None or date >= self.last_clean_up:
+            return events
+        saved = {(event.invitee, event.date, event.time) for event in events}
+        return events + [event for event in self.archive.events_on_date(date)
+                         if (event.invitee, event.date, event.time) not in saved]
+
+    def events_between_dates(self, start: int, end: int) -> list:
+        """
+        This function returns the events on the dates between the two positions of the sorted
+        date list. This should not be run alone.
+        :param start:
+        :param end:
+        :return:
+        """
         data = []
-        for event in self.event_data:
-            if event.convert_date() == date:
-                data.append(event)
+        for date in self.dates[start:end]:
+            data.extend(self.by_date[date])
         return data
 
+    def events_to_indexes(self, events: list) -> list:
+        """
+        This function returns the positions within event_data of the events provided. This
+        should not be run alone.
+        :param events:
+        :return:
+        """
+        wanted = set(map(id, events))
+        return [count for count, event in enumerate(self.event_data) if id(event) in wanted]
+
     def events_before_date(self, date: datetime.date, indexed: bool = False) -> list:
         """
         This function return any events before a certain date with an option to return the
@@ -465,14 +2000,8 @@ class Database:
         :param indexed:
         :return:
         """
-        data = []
-        for count, event in enumerate(self.event_data):
-            if event.convert_date() < date:
-                if indexed:
-                    data.append(count)
-                else:
-                    data.append(event)
-        return data
+        data = self.events_between_dates(0, bisect.bisect_left(self.dates, date))
+        return self.events_to_indexes(data) if indexed else data
 
     def events_after_date(self, date: datetime.date, indexed: bool = False) -> list:
         """
@@ -482,14 +2011,8 @@ class Database:
         :param indexed:
         :return:
         """
-        data = []
-        for count, event in enumerate(self.event_data):
-            if event.convert_date > date:
-                if indexed:
-                    data.append(count)
-                else:
-                    data.append(event)
-        return data
+        data = self.events_between_dates(bisect.bisect_right(self.dates, date), len(self.dates))
+        return self.events_to_indexes(data) if indexed else data
 
     def events_tomorrow(self) -> list:
         """
@@ -536,9 +2059,10 @@ class Database:
     def remove_event(self, event: Event) -> bool:
         try:
             del self.event_data[self.event_data.index(event)]
-            return True
         except ValueError:
             return False
+        self.unindex_event(event)
+        return True
 
     def mark_as_notified(self, event: Event) -> bool:
         """
@@ -547,11 +2071,10 @@ class Database:
         :param event:
         :return:
         """
-        try:
-            self.event_data[self.event_data.index(event)].notified = True
-            return True
-        except ValueError:
+        if event is None or self.by_key.get((event.invitee, event.date, event.time)) is not event:
             return False
+        event.notified = True
+        return True
 
     def search_by_name(self, name: str) -> list:
         """
@@ -567,28 +2090,48 @@ class Database:
         return result
 
     def search_by_name_date_time(self, name: str, date: str, time_: str):
-        for event in self.event_data:
-            if (event.invitee, event.date, event.time) == (name, date, time_):
+        return self.by_key.get((name, date, time_)) or self.search_archive(name, date, time_)
+
+    def search_archive(self, name: str, date: str, time_: str):
+        """
+        This function looks for an event that was moved to the archive by a cleanup. This
+        should not be run alone.
+        :param name:
+        :param date:
+        :param time_:
+        :return:
+        """
+        day = datetime.date.fromisoformat(date)
+        if self.archive is None or day >= self.last_clean_up:
+            return None
+        for event in self.archive.events_on_date(day):
+            if event.invitee == name and event.time == time_:
                 return event
         return None
 
-    def check_for_cleanup(self) -> None:
+    def check_for_cleanup(self) -> int:
         """
         This function checks if the database has been cleaned today and if not
-        then it will call on the self cleanup function.
+        then it will call on the self cleanup function. It returns how many events were cleared.
         :return:
         """
         if self.last_clean_up < datetime.date.today():
-            self.cleanup()
+            return self.cleanup()
+        return 0
 
     def cleanup(self) -> int:
         """
-        This function checks for any events that have passed and will delete them.
+        This function checks for any events that have passed and moves them to the archive,
+        or deletes them if there is no archive.
         :return:
         """
-        old_events = self.events_before_date(datetime.date.today(), indexed=True)
-        for count, i in enumerate(old_events):
-            del self.event_data[i - count]
+        old_events = self.events_before_date(datetime.date.today())
+        if self.archive is not None:
+            self.archive.append(old_events)
+        old_ids = set(map(id, old_events))
+        self.event_data = [event for event in self.event_data if id(event) not in old_ids]
+        for event in old_events:
+            self.unindex_event(event)
         self.last_clean_up = datetime.date.today()
         return len(old_events)
 
@@ -599,68 +2142,854 @@ class Database:
         """
         if 'y' == input("Would you like to delete the contents of the database? (y/n): ").lower():
             del self.event_data[:]
+            self.reindex()
             save_db(self)
             print('Data deleted.')
 
 
+class SQLiteDatabase(Database):
+
+    def __init__(self, file: str = 'tutoring.sqlite3', archive: Archive = None):
+        self.file = file
+        self.archive = archive
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(file, timeout=30, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        # WAL lets the viewer read while the core script is writing.
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS events ('
+                                    'invitee TEXT NOT NULL, invitee_email TEXT, invitee_timezone TEXT, '
+                                    'date TEXT NOT NULL, time TEXT NOT NULL, notified INTEGER NOT NULL DEFAULT 0, '
+                                    'zoom_id TEXT, zoom_join_url TEXT, zoom_passcode TEXT, '
+                                    'PRIMARY KEY (invitee, date, time))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS events_invitee ON events (invitee COLLATE NOCASE)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS events_date ON events (date)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS events_notified ON events (notified, date)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)')
+
+    def __getstate__(self):
+        raise TypeError('A SQLiteDatabase is saved as it changes and can not be pickled.')
+
+    def execute(self, sql: str, parameters: tuple = ()) -> sqlite3.Cursor:
+        """
+        This function runs a statement in its own transaction. This should not be run alone.
+        :param sql:
+        :param parameters:
+        :return:
+        """
+        with self.lock, self.connection:
+            return self.connection.execute(sql, parameters)
+
+    def select(self, where: str = '', parameters: tuple = ()) -> list:
+        """
+        This function returns the events matching the where clause. This should not be run alone.
+        :param where:
+        :param parameters:
+        :return:
+        """
+        with self.lock:
+            rows = self.connection.execute(f'SELECT * FROM events {where}', parameters).fetchall()
+        return [Event.from_record(dict(row)) for row in rows]
+
+    @property
+    def last_clean_up(self) -> datetime.date:
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM settings WHERE name = 'last_clean_up'").fetchone()
+        # A database that was never cleaned up is cleaned up the first time it is checked.
+        return datetime.date.fromisoformat(row[0]) if row else datetime.date.min
+
+    @last_clean_up.setter
+    def last_clean_up(self, date: datetime.date):
+        self.execute("INSERT OR REPLACE INTO settings (name, value) VALUES ('last_clean_up', ?)", (str(date),))
+
+    @property
+    def event_data(self) -> list:
+        return self.select('ORDER BY rowid')
+
+    def version(self) -> tuple:
+        """
+        This function returns a value that changes whenever the events are changed by this
+        connection or any other, so a copy of the events only has to be reloaded when it differs.
+        :return:
+        """
+        with self.lock:
+            return self.connection.execute('PRAGMA data_version').fetchone()[0], self.connection.total_changes
+
+    def reindex(self) -> None:
+        pass
+
+    def store_event(self, event) -> None:
+        """
+        This function saves an event that has been fully prepared. This should not be run alone.
+        :param event:
+        :return:
+        """
+        self.store_events([event])
+
+    def store_events(self, events: list) -> None:
+        """
+        This function saves many events in a single transaction, events that are already
+        saved are left alone. This should not be run alone.
+        :param events:
+        :return:
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(f'INSERT OR IGNORE INTO events ({", ".join(EVENT_FIELDS)}) '
+                                        f'VALUES ({", ".join("?" * len(EVENT_FIELDS))})',
+                                        [tuple(getattr(event, name, None) for name in EVENT_FIELDS)
+                                         for event in events])
+
+    def event_saved(self, questioned) -> bool:
+        """
+        This function checks if the event in question is already in the database so
+         it does not add any duplicates to the system.
+        :param questioned:
+        :return:
+        """
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM events WHERE invitee = ? AND date = ? AND time = ?',
+                                           (questioned.invitee, questioned.date, questioned.time)).fetchone() \
+                is not None
+
+    def events_on_date(self, date: datetime.date) -> list:
+        """
+        This function returns any events that are happening on the specified date. Dates
+        from before the last cleanup are looked up in the archive too.
+        :param date:
+        :return:
+        """
+        return self.with_archived(date, self.select('WHERE date = ? ORDER BY time', (str(date),)))
+
+    def events_before_date(self, date: datetime.date, indexed: bool = False) -> list:
+        """
+        This function return any events before a certain date with an option to return the
+        row ids of those events.
+        :param date:
+        :param indexed:
+        :return:
+        """
+        if indexed:
+            with self.lock:
+                return [row[0] for row in self.connection.execute('SELECT rowid FROM events WHERE date < ? '
+                                                                  'ORDER BY rowid', (str(date),))]
+        return self.select('WHERE date < ? ORDER BY date, time', (str(date),))
+
+    def events_after_date(self, date: datetime.date, indexed: bool = False) -> list:
+        """
+        This function return any events after a certain date with an option to return the
+        row ids of those events.
+        :param date:
+        :param indexed:
+        :return:
+        """
+        if indexed:
+            with self.lock:
+                return [row[0] for row in self.connection.execute('SELECT rowid FROM events WHERE date > ? '
+                                                                  'ORDER BY rowid', (str(date),))]
+        return self.select('WHERE date > ? ORDER BY date, time', (str(date),))
+
+    def list_unprepared(self, days_ahead: int = 1):
+        """
+        This function will gather anyone that has not been sent a preparation email.
+        :param days_ahead: How many days ahead would you like too notify.
+        :return:
+        """
+        today = datetime.date.today()
+        return self.select('WHERE notified = 0 AND date BETWEEN ? AND ? ORDER BY date, time',
+                           (str(today), str(today + datetime.timedelta(days=days_ahead))))
+
+    def remove_event(self, event: Event) -> bool:
+        if event is None:
+            return False
+        return self.execute('DELETE FROM events WHERE invitee = ? AND date = ? AND time = ?',
+                            (event.invitee, event.date, event.time)).rowcount > 0
+
+    def mark_as_notified(self, event: Event) -> bool:
+        """
+        This function will search for the event provided and mark it as a successfully
+        emailed participant.
+        :param event:
+        :return:
+        """
+        if event is None:
+            return False
+        if self.execute('UPDATE events SET notified = 1 WHERE invitee = ? AND date = ? AND time = ?',
+                        (event.invitee, event.date, event.time)).rowcount == 0:
+            return False
+        event.notified = True
+        return True
+
+    def search_by_name(self, name: str) -> list:
+        """
+        This function takes a name and looks through all the events to return a
+        list of events that have that name on file.
+        :param name:
+        :return:
+        """
+        pattern = '%' + name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        return self.select("WHERE invitee LIKE ? ESCAPE '\\' ORDER BY rowid", (pattern,))
+
+    def search_by_name_date_time(self, name: str, date: str, time_: str):
+        events = self.select('WHERE invitee = ? AND date = ? AND time = ?', (name, date, time_))
+        return events[0] if events else self.search_archive(name, date, time_)
+
+    def cleanup(self) -> int:
+        """
+        This function checks for any events that have passed and moves them to the archive,
+        or deletes them if there is no archive. They are archived before they are deleted so
+        a crash in between only archives them twice, which the archive ignores.
+        :return:
+        """
+        today = str(datetime.date.today())
+        if self.archive is not None:
+            self.archive.append(self.select('WHERE date < ? ORDER BY date, time', (today,)))
+        removed = self.execute('DELETE FROM events WHERE date < ?', (today,)).rowcount
+        self.last_clean_up = datetime.date.today()
+        return removed
+
+    def destroy(self) -> None:
+        """
+        This function removes all the event data saved within the database.
+        :return:
+        """
+        if 'y' == input("Would you like to delete the contents of the database? (y/n): ").lower():
+            self.execute('DELETE FROM events')
+            print('Data deleted.')
+
+    def commit(self) -> None:
+        """
+        This function makes sure everything is written to disk. Every change is already
+        committed as it is made so this only matters if the connection was used directly.
+        :return:
+        """
+        with self.lock:
+            self.connection.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def migrate_pickle(legacy_file: str, database: SQLiteDatabase) -> int:
+    """
+    This function copies the events of an old pickled database into the SQLite database
+    and renames the old file so it is only imported once. It returns how many events were copied.
+    :param legacy_file:
+    :param database:
+    :return:
+    """
+    with open(legacy_file, 'rb') as f:
+        legacy = pickle.load(f)
+    database.store_events(legacy.event_data)
+    database.last_clean_up = legacy.last_clean_up
+    try:
+        os.replace(legacy_file, legacy_file + '.migrated')
+    except FileNotFoundError:
+        # Another process finished the same migration first.
+        pass
+    return len(legacy.event_data)
+
+
+@instrument('save_db')
 def save_db(db: Database, file: str = 'tutoring.database') -> None:
     """
     This function takes a Database object and serializes the data so it can be
-    saved as a file and loaded again at a later date.
+    saved as a file and loaded again at a later date. A SQLiteDatabase saves itself
+    as it changes so it is only committed.
     :param db:
     :param file:
     :return:
     """
+    if isinstance(db, SQLiteDatabase):
+        db.commit()
+        return
     with open(file, 'wb') as f:
         pickle.dump(db, f)
 
 
-def open_db(file: str = 'tutoring.database') -> Database:
+@instrument('open_db')
+def open_db(file: str = 'tutoring.sqlite3', legacy_file: str = 'tutoring.database') -> Database:
     """
-    This function returns a database object, if there is not one on file then it
-    will create a new one.
+    This function returns the SQLite database, if there is not one on file then it
+    will create a new one. An old pickled database found on file is imported the first time.
+    Past events are archived in the 'archive' folder next to the database.
     :param file:
+    :param legacy_file:
     :return:
     """
-    if os.path.isfile(file):
-        with open(file, 'rb') as f:
-            saved_db = pickle.load(f)
-        return saved_db
-    return Database()
+    database = SQLiteDatabase(file, Archive(os.path.join(os.path.dirname(file), 'archive')))
+    if legacy_file and os.path.isfile(legacy_file):
+        print(migrate_pickle(legacy_file, database), 'Events imported from', legacy_file)
+    return database
+
+
+class Journal:
+
+    def __init__(self, file: str = 'tutoring.journal'):
+        """
+        This is an append only file of the outside actions (zoom meetings, calendar events and
+        emails) each event is about to do and has done. Every line is flushed to disk before
+        the action goes ahead, which costs far less than saving the whole database, so after a
+        crash replay can finish only what was left undone. An action that was started but
+        never written down as done is done again, so a crash at exactly the wrong moment can
+        still repeat it once.
+        :param file:
+        """
+        self.file = file
+        self.lock = threading.Lock()
+        self.records = {}
+        self.stages = {}
+        self.intents = {}
+        self.failures = {}
+        if os.path.isfile(self.file):
+            with open(self.file, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash is ignored.
+                        continue
+                    self.load(entry)
+
+    def load(self, entry: dict) -> None:
+        """
+        This function applies one line of the journal. This should not be run alone.
+        :param entry:
+        :return:
+        """
+        key = tuple(entry['event'])
+        if 'record' in entry:
+            self.records[key] = entry['record']
+        if 'intent' in entry:
+            self.intents.setdefault(key, set()).add(entry['intent'])
+            # Starting a stage again means its last failure no longer counts.
+            self.failures.get(key, set()).discard(entry['intent'])
+        if 'failed' in entry:
+            self.failures.setdefault(key, set()).add(entry['failed'])
+        if 'stage' in entry:
+            self.stages.setdefault(key, {})[entry['stage']] = entry.get('data')
+
+    def append(self, entry: dict) -> None:
+        """
+        This function adds a line to the journal and waits for it to reach the disk. This
+        should not be run alone.
+        :param entry:
+        :return:
+        """
+        with self.lock:
+            self.load(entry)
+            with open(self.file, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
 
+    def begin(self, event, stage: str) -> None:
+        """
+        This function writes down that an action is about to happen. The first time an event
+        is seen its fields are saved too so it can be rebuilt by replay.
+        :param event:
+        :param stage:
+        :return:
+        """
+        key = (event.invitee, event.date, event.time)
+        entry = {'event': key, 'intent': stage}
+        if key not in self.records:
+            entry['record'] = {name: getattr(event, name, None) for name in EVENT_FIELDS}
+        self.append(entry)
 
-def internet_active() -> bool:
-    """
-    This function checks if you are connected to the internet. It only request the head of
-    the website as to not waist time gathering the whole page.
-    """
-    connection = http.HTTPConnection("www.google.com", timeout=5)
-    try:
-        connection.request("HEAD", "/")
-        connection.close()
+    def completed(self, event) -> dict:
+        """
+        This function returns the stages the event has finished and the data they recorded.
+        :param event:
+        :return:
+        """
+        with self.lock:
+            return dict(self.stages.get((event.invitee, event.date, event.time), {}))
+
+    def record(self, event, stage: str, data=None) -> None:
+        """
+        This function writes down that a stage of an event has finished.
+        :param event:
+        :param stage:
+        :param data:
+        :return:
+        """
+        self.append({'event': (event.invitee, event.date, event.time), 'stage': stage, 'data': data})
+
+    def fail(self, event, stage: str) -> None:
+        """
+        This function writes down that a stage of an event ran out of retries, so it is known
+        not to have happened rather than stopped by a crash.
+        :param event:
+        :param stage:
+        :return:
+        """
+        self.append({'event': (event.invitee, event.date, event.time), 'failed': stage})
+
+    def interrupted(self, event) -> list:
+        """
+        This function returns the stages of the event that were started but never written down
+        as finished or failed. A crash in the middle of one may have done it already, such as
+        sending the email before it could be written down.
+        :param event:
+        :return:
+        """
+        key = (event.invitee, event.date, event.time)
+        with self.lock:
+            return sorted(self.intents.get(key, set()) - set(self.stages.get(key, {})) - self.failures.get(key, set()))
+
+    def unfinished(self, finished: str = 'saved') -> list:
+        """
+        This function returns the events that were started but never reached the finished stage.
+        :param finished:
+        :return:
+        """
+        with self.lock:
+            return [Event.from_record(record) for key, record in self.records.items()
+                    if finished not in self.stages.get(key, {})]
+
+    def compact(self, finished: str = 'saved') -> None:
+        """
+        This function rewrites the file without the events that have reached the finished
+        stage or already happened since they will never be looked at again.
+        :param finished:
+        :return:
+        """
+        today = str(datetime.date.today())
+        with self.lock:
+            keep = {key for key, record in self.records.items()
+                    if finished not in self.stages.get(key, {}) and key[1] >= today}
+            self.records = {key: self.records[key] for key in keep}
+            self.stages = {key: self.stages[key] for key in keep if key in self.stages}
+            self.intents = {key: self.intents[key] for key in keep if key in self.intents}
+            self.failures = {key: self.failures[key] for key in keep if key in self.failures}
+            lines = []
+            for key in keep:
+                lines.append({'event': key, 'record': self.records[key]})
+                lines.extend({'event': key, 'intent': stage} for stage in self.intents.get(key, ()))
+                lines.extend({'event': key, 'failed': stage} for stage in self.failures.get(key, ()))
+                lines.extend({'event': key, 'stage': stage, 'data': data}
+                             for stage, data in self.stages.get(key, {}).items())
+            write_atomically(self.file, ''.join(json.dumps(line) + '\n' for line in lines))
+
+
+class IngestPipeline:
+
+    def __init__(self, database: Database, zoom: Zoom, calendar: Calendar, alert: Alert, journal: Journal,
+                 workers: int = 4, retries: int = 2, backoff: float = 1, days_ahead: int = 1,
+                 batch_size: int = 50, batch_wait: float = 0.5):
+        """
+        This schedules new events with up to 'workers' events in progress at the same time.
+        Every event first gets its zoom meeting, then the calendar event and the confirmation
+        email (only for events within 'days_ahead' days, like list_unprepared) are done at the
+        same time since both only need the zoom link. The calendar events of the events whose
+        meeting is ready are gathered for up to 'batch_wait' seconds and added in batches of up
+        to 'batch_size' with Calendar.add_calendar_events. Each stage is tried 'retries' more
+        times if it fails and every action is written to the Journal before and after it happens.
+        :param database:
+        :param zoom:
+        :param calendar:
+        :param alert:
+        :param journal:
+        :param workers:
+        :param retries:
+        :param backoff:
+        :param days_ahead:
+        :param batch_size:
+        :param batch_wait:
+        """
+        self.database = database
+        self.zoom = zoom
+        self.calendar = calendar
+        self.alert = alert
+        self.journal = journal
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.days_ahead = days_ahead
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.lock = threading.Lock()
+        self.calendar_queue = queue.Queue()
+        self.pool = None
+
+    def run(self, events, outdated_ok: bool = False, failed: list = None) -> int:
+        """
+        This function schedules the events as they are handed over and returns how many were
+        added. Events that could not be finished are put in the failed list if one is provided.
+        :param events:
+        :param outdated_ok:
+        :param failed:
+        :return:
+        """
+        in_progress = set()
+        # Enough events are let through for a full calendar batch to gather behind the zoom meetings.
+        slots = threading.BoundedSemaphore(self.workers * 2 + self.batch_size)
+        results = []
+        added = 0
+        batcher = threading.Thread(target=self.send_to_calendar, daemon=True)
+        batcher.start()
+        with ThreadPoolExecutor(max_workers=self.workers) as self.pool:
+            try:
+                for event in events:
+                    if not event.valid or (event.convert_date() < datetime.date.today() and not outdated_ok):
+                        continue
+                    key = (event.invitee, event.date, event.time)
+                    if key in in_progress or self.database.event_saved(event):
+                        continue
+                    in_progress.add(key)
+                    # Waits here while enough events are in progress so emails are not downloaded too far ahead.
+                    slots.acquire()
+                    finished = Future()
+                    finished.add_done_callback(functools.partial(self.finished, slots, perf_counter()))
+                    self.pool.submit(self.process, event, finished)
+                    results.append((event, finished))
+                # The pool is kept open until every event is done since the calendar batches hand
+                # their events back to it.
+                for event, finished in results:
+                    error = finished.exception()
+                    if error:
+                        print(f'{event.invitee} could not be scheduled: {error!r}')
+                        if failed is not None:
+                            failed.append(event)
+                    else:
+                        added += 1
+            finally:
+                self.calendar_queue.put(None)
+                batcher.join()
+        self.journal.compact()
+        return added
+
+    @staticmethod
+    def finished(slots, started: float, finished: Future) -> None:
+        """
+        This function frees the place of an event that is done and times it as the stage
+        'schedule_event'. This should not be run alone.
+        :param slots:
+        :param started:
+        :param finished:
+        :return:
+        """
+        slots.release()
+        if metrics.enabled:
+            metrics.observe('schedule_event', perf_counter() - started, error=finished.exception() is not None)
+
+    def replay(self, failed: list = None) -> int:
+        """
+        This function finishes the events a run that crashed left half done. Only the actions
+        that never finished are done again. It returns how many events were added.
+        :param failed:
+        :return:
+        """
+        pending = []
+        for event in self.journal.unfinished():
+            if self.database.event_saved(event):
+                # It crashed after saving the event but before writing that down.
+                self.journal.record(event, 'saved')
+            else:
+                pending.append(event)
+        if pending:
+            print(f'Finishing {len(pending)} events from the last run.')
+        for event in pending:
+            interrupted = self.journal.interrupted(event)
+            if interrupted:
+                print(f'{event.invitee} was stopped in the middle of {", ".join(interrupted)}, '
+                      f'it is done again and may happen twice.')
+        return self.run(pending, failed=failed)
+
+    def attempt(self, stage: str, event, action):
+        """
+        This function runs one stage, trying again with a growing wait if it fails. This
+        should not be run alone.
+        :param stage:
+        :param event:
+        :param action:
+        :return:
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return action()
+            except Exception as e:
+                if attempt == self.retries:
+                    self.journal.fail(event, stage)
+                    raise
+                print(f'The {stage} stage of {event.invitee} failed ({e!r}), trying again.')
+                sleep(self.backoff * 2 ** attempt)
+
+    def process(self, event, finished: Future) -> None:
+        """
+        This function creates the zoom meeting of an event and queues its confirmation email,
+        then hands it to the calendar batches, or straight to finish if its calendar event
+        was already added. This should not be run alone.
+        :param event:
+        :param finished:
+        :return:
+        """
+        try:
+            done = self.journal.completed(event)
+
+            if 'zoom' in done:
+                event.zoom_id, event.zoom_join_url, event.zoom_passcode = done['zoom']
+            elif not event.zoom_join_url:
+                def create_meeting():
+                    meeting = self.zoom.create_meeting(event)
+                    if 'join_url' not in meeting:
+                        raise ValueError(meeting.get('message', meeting))
+                    return meeting['id'], meeting['join_url'], meeting['password']
+
+                self.journal.begin(event, 'zoom')
+                event.zoom_id, event.zoom_join_url, event.zoom_passcode = self.attempt('zoom', event, create_meeting)
+                self.journal.record(event, 'zoom', [event.zoom_id, event.zoom_join_url, event.zoom_passcode])
+
+            # The email is queued first so it is sent while the calendar event is being added.
+            confirmation = None
+            due = event.convert_date() <= datetime.date.today() + datetime.timedelta(days=self.days_ahead)
+            if 'email' not in done and due:
+                subject, message = confirmation_email(event)
+                self.journal.begin(event, 'email')
+                confirmation = (subject, message, self.alert.Email(Receiver=event.invitee_email, Message=message,
+                                                                   Subject=subject))
+
+            if 'calendar' in done:
+                self.finish(event, done, confirmation, finished)
+            else:
+                self.journal.begin(event, 'calendar')
+                self.calendar_queue.put((event, done, confirmation, finished, 0))
+        except Exception as e:
+            finished.set_exception(e)
+
+    def send_to_calendar(self) -> None:
+        """
+        This function is what the calendar thread runs. It waits for an event, gathers the
+        ones that come in the next 'batch_wait' seconds and adds them all to the calendar at
+        once. An event that failed is put back in the queue after a growing wait until it runs
+        out of retries. This should not be run alone.
+        :return:
+        """
+        while True:
+            batch = [self.calendar_queue.get()]
+            if batch[0] is None:
+                return
+            deadline = monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.calendar_queue.get(timeout=max(deadline - monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Everything queued before the stop is still added.
+                    self.calendar_queue.put(None)
+                    break
+                batch.append(item)
+            try:
+                errors = self.calendar.add_calendar_events([item[0] for item in batch])
+            except Exception as e:
+                errors = [e] * len(batch)
+            for (event, done, confirmation, finished, attempt), error in zip(batch, errors):
+                if error and attempt < self.retries:
+                    print(f'The calendar stage of {event.invitee} failed ({error!r}), trying again.')
+                    retry = threading.Timer(self.backoff * 2 ** attempt, self.calendar_queue.put,
+                                            [(event, done, confirmation, finished, attempt + 1)])
+                    retry.daemon = True
+                    retry.start()
+                    continue
+                self.pool.submit(self.finish, event, done, confirmation, finished, error)
+
+    def finish(self, event, done: dict, confirmation, finished: Future, error: Exception = None) -> None:
+        """
+        This function writes down the calendar event, waits for the confirmation email and
+        saves the event, or fails it with the calendar's error. This should not be run alone.
+        :param event:
+        :param done:
+        :param confirmation:
+        :param finished:
+        :param error:
+        :return:
+        """
+        try:
+            if 'calendar' not in done:
+                if error:
+                    self.journal.fail(event, 'calendar')
+                else:
+                    self.journal.record(event, 'calendar')
+            # Even if the calendar failed the email has to be written down once it is sent.
+            if confirmation is not None:
+                subject, message, delivery = confirmation
+                try:
+                    if delivery.exception():
+                        self.attempt('email', event, lambda: self.alert.Email(
+                            Receiver=event.invitee_email, Message=message, Subject=subject).result())
+                    self.journal.record(event, 'email')
+                    done['email'] = None
+                except Exception as e:
+                    # The event is still saved, the email is tried again by send_confirmations.
+                    print(f'{event.invitee} could not be emailed: {e!r}')
+            if error:
+                raise error
+
+            with self.lock:
+                event.notified = 'email' in done
+                self.database.store_event(event)
+            self.journal.record(event, 'saved')
+            print(f'{event.invitee} has been scheduled for {event.get_month()} {event.get_suffix()}.')
+            finished.set_result(None)
+        except Exception as e:
+            finished.set_exception(e)
+
+
+class SessionManager:
+
+    def __init__(self, margin: float = 5 * 60, retry: float = 5, max_retry: float = 5 * 60):
+        """
+        This keeps every service logged in from a background thread. Each service registers
+        a login function that returns (session or token, expiry time or None). The result is
+        cached and the login is run again 'margin' seconds before it expires, so nothing has
+        to stop and log in while it is working. A failed login is retried, waiting longer each
+        time up to 'max_retry' seconds.
+        :param margin:
+        :param retry:
+        :param max_retry:
+        """
+        self.margin = margin
+        self.retry = retry
+        self.max_retry = max_retry
+        self.services = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+    def register(self, name: str, login) -> None:
+        """
+        This function adds a service to be kept logged in.
+        :param name:
+        :param login:
+        :return:
+        """
+        with self.lock:
+            self.services[name] = {'login': login, 'session': None, 'expires': None, 'due': 0,
+                                   'delay': self.retry, 'error': None, 'ready': threading.Event()}
+        self.wake.set()
+
+    def start(self) -> None:
+        """
+        This function starts logging in to every registered service in the background.
+        :return:
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped = True
+        self.wake.set()
+
+    def refresh(self, name: str) -> None:
+        """
+        This function runs the login of a service and records the result. This should not
+        be run alone.
+        :param name:
+        :return:
+        """
+        service = self.services[name]
+        try:
+            session, expires = service['login']()
+        except Exception as e:
+            service['error'] = e
+            service['due'] = monotonic() + service['delay']
+            print(f'Could not log into {name} ({e!r}), trying again in {service["delay"]:.0f} seconds.')
+            service['delay'] = min(service['delay'] * 2, self.max_retry)
+            return
+        service.update(session=session, expires=expires, error=None, delay=self.retry)
+        service['due'] = float('inf') if expires is None else monotonic() + max(expires - time() - self.margin, 1)
+        service['ready'].set()
+
+    def run(self) -> None:
+        """
+        This function is what the background thread runs. This should not be run alone.
+        :return:
+        """
+        while not self.stopped:
+            self.wake.clear()
+            with self.lock:
+                names = list(self.services)
+            for name in names:
+                if self.services[name]['due'] <= monotonic():
+                    self.refresh(name)
+            with self.lock:
+                due = min((service['due'] for service in self.services.values()), default=float('inf'))
+            self.wake.wait(None if due == float('inf') else max(due - monotonic(), 0))
+
+    def ready(self, name: str) -> bool:
+        """
+        This function returns if the service is logged in.
+        :param name:
+        :return:
+        """
+        return name in self.services and self.services[name]['ready'].is_set()
+
+    def wait(self, names: list = None, timeout: float = None) -> bool:
+        """
+        This function waits for the services named, or all of them, to be logged in and
+        returns False if the time ran out first.
+        :param names:
+        :param timeout:
+        :return:
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        for name in names or list(self.services):
+            remaining = None if deadline is None else max(deadline - monotonic(), 0)
+            if not self.services[name]['ready'].wait(remaining):
+                return False
         return True
-    except:
-        connection.close()
-        return False
 
+    def require(self, names: list = None, timeout: float = 5 * 60) -> None:
+        """
+        This function waits like wait does, but if the time runs out it stops logging in and
+        raises an error with the status of every service, so a wrong password does not keep
+        a run going forever.
+        :param names:
+        :param timeout:
+        :return:
+        """
+        if not self.wait(names, timeout):
+            self.stop()
+            raise TimeoutError(f'Could not log in within {timeout:.0f} seconds: {self.status()}')
 
-def main():
-    # Setting the database as global so it can be called upon within the python interactive mode.
-    global database
+    def session(self, name: str, timeout: float = None):
+        """
+        This function returns the cached session or token of a service, waiting for it to
+        log in if it has not yet.
+        :param name:
+        :param timeout:
+        :return:
+        """
+        self.wait([name], timeout)
+        return self.services[name]['session']
 
-    # Waits for an internet connection.
-    while not internet_active():
-        sleep(5)
+    def status(self) -> dict:
+        """
+        This function returns 'ready', 'waiting' or the last error for every service.
+        :return:
+        """
+        return {name: 'ready' if service['ready'].is_set() else repr(service['error']) if service['error']
+                else 'waiting' for name, service in self.services.items()}
 
-    # Opens the database / create new one if none exists.
-    database = open_db()
-    # Cleans up database to save disk space. Commenting this out will not affect the program.
-    print(database.check_for_cleanup(), 'Old Events Cleared.')
 
+def connect_services(sessions: SessionManager = None) -> tuple:
+    """
+    This function logs into every service the script uses and returns them as
+    (gmail retriever, gmail sender, zoom, calendar). If a SessionManager is provided the
+    logging in happens in the background instead, use sessions.wait to know when it is done.
+    :param sessions:
+    :return:
+    """
     # Logging into Gmail with 'username' and 'password' credentials. You will either have to
     # set up a app key or make your account unsecure to allow the program to read your emails.
     # Here is the link: https://myaccount.google.com/security
-    gmail_retriever = Gmail('YOUR_GMAIL_USERNAME', 'YOUR_GMAIL_PASSWORD')
+    gmail_retriever = Gmail('YOUR_GMAIL_USERNAME', 'YOUR_GMAIL_PASSWORD', connect=sessions is None)
     gmail_sender = Alert('YOUR_GMAIL_USERNAME', 'YOUR_GMAIL_PASSWORD')
 
     # Logging into Zoom with 'key' and 'secret' credentials. Here is a tutorial on the zoom
@@ -679,47 +3008,475 @@ def main():
     # Telling Gmail to look at anything set with the "Tutoring" Label.
     gmail_retriever.set_label('Tutoring')
 
-    # Gather all emails and loop through them.
-    for message in gmail_retriever.get_messages():
-        # Gather only the useful information from the message and send it to the database
-        event = Event(message)
-        database.append_event(event, zoom, calendar)
+    if sessions is not None:
+        sessions.register('gmail', lambda: (gmail_retriever.reconnect(), None))
+        sessions.register('zoom', zoom.renew_auth_token)
+        sessions.register('calendar', calendar.refresh_login)
+        sessions.start()
+    return gmail_retriever, gmail_sender, zoom, calendar
 
-    for event in database.list_unprepared():
-        subject = f'Cybersecurity Boot Camp - Tutorial Confirmation - {event.get_day_of_week()}, {event.get_month()} ' \
-                  f'{event.get_suffix()}, at {event.get_standard_time()}, Pacific.'
-
-        message = f'Hi {event.invitee.split(" ")[0]}!\n' \
-                  f'Thank you for scheduling your session with me. I am looking forward to our session on ' \
-                  f'{event.get_day_of_week()}, {event.get_month()} {event.get_suffix()}, at ' \
-                  f'{event.get_standard_time()}, Pacific.\n\n' \
-                  f'If something comes up and the scheduled time will not work, let me know a minimum of 6 hours' \
-                  f' before the appointment time and we’ll figure something out.\n\n' \
-                  f'This session will take place here:\n\n' \
-                  f'Join Zoom Meeting\n' \
-                  f'{event.zoom_join_url}\n\n' \
-                  f'Meeting ID: {event.zoom_id}\n' \
-                  f'Passcode: {event.zoom_passcode}\n\n' \
-                  f'(If you have not used zoom before please join the meeting at least 15 minutes early because it' \
-                  f' may have you download and install some software.)\n\n' \
-                  f'Again, all I need from you:\n' \
-                  f'• Be on Tutors & Students Slack 5 minutes before your time slot.\n' \
-                  f'• Make sure your computer/mic/internet connection is working.\n' \
-                  f'• Make sure your workspace is quiet and free from interruptions.\n' \
-                  f'• At the end of the session, I will provide you with a link to a 2-minute evaluation form ' \
-                  f'that you are required to complete.\n\n' \
-                  f'Slack or email me with any questions. I’m looking forward to our meeting!\n\n' \
-                  f'Please Reply All to this email so that I know you have seen it.\n\n' \
-                  f'(CC Central Support on all tutor emails by always using REPLY ALL).\n\n' \
-                  f'Sincerely,\n' \
-                  f'YOUR NAME\n'
-        gmail_sender.Email(Receiver=event.invitee_email, Message=message, Subject=subject, Image=None)
-        print(f'{event.invitee} is receiving an email!')
-        database.mark_as_notified(event)
+
+# More new emails than this are downloaded over several connections, see backfill_new_mail.
+BACKFILL_MESSAGES = 1000
+
+
+def schedule_new_mail(database: Database, gmail_retriever: Gmail, pipeline: IngestPipeline,
+                      sync_state: SyncState, cache: ParseCache = None, connections: int = 1) -> int:
+    """
+    This function downloads the emails that arrived since the last sync, schedules their
+    events and saves how far it got. It returns how many events were added. With a
+    ParseCache emails that were already parsed in an earlier run are not downloaded again,
+    and with more than one connection a large number of new emails is backfilled instead.
+    :param database:
+    :param gmail_retriever:
+    :param pipeline:
+    :param sync_state:
+    :param cache:
+    :param connections:
+    :return:
+    """
+    uids = None
+    if cache is not None and connections > 1:
+        uids = gmail_retriever.search_uids(after=sync_state.last_uid(gmail_retriever.label,
+                                                                     gmail_retriever.uidvalidity))
+        if len(uids) > BACKFILL_MESSAGES:
+            return backfill_new_mail(database, gmail_retriever, pipeline, sync_state, cache, uids, connections)
+
+    # Stream all new emails into the database, each one is scheduled as soon as it is downloaded.
+    # Only the headers are looked at first so nothing but Calendly notifications are downloaded.
+    if cache is not None:
+        # The UIDs searched for above are not searched for again.
+        events = gmail_retriever.iter_events(cache, sync_state=sync_state, batch_size=200, sender='calendly.com',
+                                             uids=uids)
+    else:
+        messages = gmail_retriever.iter_messages(sync_state=sync_state, batch_size=200, sender='calendly.com')
+        # Gather only the useful information from each message.
+        events = (Event(message) for message in messages)
+    # The pipeline works on a few events at the same time.
+    failed = []
+    try:
+        added = pipeline.run(events, failed=failed)
+    finally:
+        if cache is not None:
+            cache.save()
+    metrics.count('events_added', added)
+    metrics.count('events_failed', len(failed))
+    print(f'Gmail: {gmail_retriever.round_trips} round trips, {gmail_retriever.bytes_received} bytes received.')
 
     # serialize the database and save it as a file.
     save_db(database)
+    # The new emails are safely in the database so they don't need to be downloaded again. If any
+    # failed the emails are downloaded again next time so they can be retried.
+    if failed:
+        print(f'{len(failed)} events could not be scheduled and will be tried again next run.')
+        sync_state.load()
+    else:
+        sync_state.save()
+    return added
+
+
+def backfill_new_mail(database: Database, gmail_retriever: Gmail, pipeline: IngestPipeline, sync_state: SyncState,
+                      cache: ParseCache, uids: list, connections: int = 4, checkpoint: int = 2000) -> int:
+    """
+    This function schedules the events of a large number of emails, such as a whole label on
+    first setup, downloading them over several connections with Gmail.backfill. Every
+    'checkpoint' emails the events found so far are scheduled and saved and the sync state is
+    moved past them, so a backfill that is stopped picks up from the last checkpoint next run.
+    It prints how far along it is at every checkpoint and returns how many events were added.
+    :param database:
+    :param gmail_retriever:
+    :param pipeline:
+    :param sync_state:
+    :param cache:
+    :param uids:
+    :param connections:
+    :param checkpoint:
+    :return:
+    """
+    label, uidvalidity = gmail_retriever.label, gmail_retriever.uidvalidity
+    print(f'Backfilling {len(uids):,} emails from {label} over {connections} connections.')
+    start = perf_counter()
+    added = done = 0
+    failed = []
+    events = []
+    saved = 0
+    ranges = gmail_retriever.backfill(cache, uids, connections, sender='calendly.com')
+    try:
+        for chunk, found in ranges:
+            events.extend(found)
+            done += len(chunk)
+            if done - saved < checkpoint and done < len(uids):
+                continue
+            added += pipeline.run(events, failed=failed)
+            events = []
+            if failed:
+                break
+            save_db(database)
+            cache.save()
+            sync_state.update(label, uidvalidity, chunk[-1])
+            sync_state.save()
+            saved = done
+            elapsed = perf_counter() - start
+            print(f'Backfill: {done:,} of {len(uids):,} emails ({done / len(uids):.0%}), {added} events added, '
+                  f'{done / elapsed:,.0f} emails/s, about {(len(uids) - done) * elapsed / done:.0f}s left.')
+    finally:
+        ranges.close()
+        cache.save()
+    metrics.count('events_added', added)
+    metrics.count('events_failed', len(failed))
+    print(f'Gmail: {gmail_retriever.round_trips} round trips, {gmail_retriever.bytes_received} bytes received.')
+
+    save_db(database)
+    if failed:
+        print(f'{len(failed)} events could not be scheduled, the backfill will carry on from {saved:,} emails '
+              f'next run.')
+        sync_state.load()
+    return added
+
+
+# The fields every email template can use, see event_context.
+CONTEXT_FIELDS = ('invitee', 'first_name', 'invitee_email', 'date', 'day_of_week', 'month', 'day', 'standard_time',
+                  'zoom_join_url', 'zoom_id', 'zoom_passcode')
+
+
+class Template:
+
+    def __init__(self, subject: str, message: str):
+        """
+        This is an email that is filled in with the fields of an event from event_context.
+        It is tried out once when it is made so a misspelled field fails right away instead
+        of on the first send, after that filling it in is a single format_map per part.
+        :param subject:
+        :param message:
+        """
+        self.subject = subject
+        self.message = message
+        self.render(dict.fromkeys(CONTEXT_FIELDS, ''))
+
+    def render(self, context: dict) -> tuple:
+        """
+        This function fills in the template and returns (subject, message).
+        :param context:
+        :return:
+        """
+        return self.subject.format_map(context), self.message.format_map(context)
+
+
+CONFIRMATION = Template(
+    'Cybersecurity Boot Camp - Tutorial Confirmation - {day_of_week}, {month} {day}, at {standard_time}, Pacific.',
+    'Hi {first_name}!\n'
+    'Thank you for scheduling your session with me. I am looking forward to our session on '
+    '{day_of_week}, {month} {day}, at {standard_time}, Pacific.\n\n'
+    'If something comes up and the scheduled time will not work, let me know a minimum of 6 hours'
+    ' before the appointment time and we’ll figure something out.\n\n'
+    'This session will take place here:\n\n'
+    'Join Zoom Meeting\n'
+    '{zoom_join_url}\n\n'
+    'Meeting ID: {zoom_id}\n'
+    'Passcode: {zoom_passcode}\n\n'
+    '(If you have not used zoom before please join the meeting at least 15 minutes early because it'
+    ' may have you download and install some software.)\n\n'
+    'Again, all I need from you:\n'
+    '• Be on Tutors & Students Slack 5 minutes before your time slot.\n'
+    '• Make sure your computer/mic/internet connection is working.\n'
+    '• Make sure your workspace is quiet and free from interruptions.\n'
+    '• At the end of the session, I will provide you with a link to a 2-minute evaluation form '
+    'that you are required to complete.\n\n'
+    'Slack or email me with any questions. I’m looking forward to our meeting!\n\n'
+    'Please Reply All to this email so that I know you have seen it.\n\n'
+    '(CC Central Support on all tutor emails by always using REPLY ALL).\n\n'
+    'Sincerely,\n'
+    'YOUR NAME\n')
+
+
+def event_context(event) -> dict:
+    """
+    This function works out everything a template can say about an event, each of the
+    event's date and time conversions is only done once no matter how often it is used.
+    :param event:
+    :return:
+    """
+    return {'invitee': event.invitee,
+            'first_name': event.invitee.split(' ')[0],
+            'invitee_email': event.invitee_email,
+            'date': event.date,
+            'day_of_week': event.get_day_of_week(),
+            'month': event.get_month(),
+            'day': event.get_suffix(),
+            'standard_time': event.get_standard_time(),
+            'zoom_join_url': event.zoom_join_url,
+            'zoom_id': event.zoom_id,
+            'zoom_passcode': event.zoom_passcode}
+
+
+def confirmation_email(event) -> tuple:
+    """
+    This function writes the confirmation email for an event and returns (subject, message).
+    :param event:
+    :return:
+    """
+    return CONFIRMATION.render(event_context(event))
+
+
+def send_confirmations(database: Database, gmail_sender: Alert) -> int:
+    """
+    This function emails everyone with an upcoming event that has not been emailed yet and
+    returns how many were sent.
+    :param database:
+    :param gmail_sender:
+    :return:
+    """
+    # Emails are queued and sent over a few long lived connections.
+    sending = []
+    for event in database.list_unprepared():
+        subject, message = confirmation_email(event)
+        sending.append((event, gmail_sender.Email(Receiver=event.invitee_email, Message=message, Subject=subject,
+                                                  Image=None)))
+
+    # Only events whose email was actually sent are marked, the rest are tried again next run.
+    sent = 0
+    for event, delivery in sending:
+        error = delivery.exception()
+        if error:
+            print(f'{event.invitee} could not be emailed: {error!r}')
+            continue
+        print(f'{event.invitee} has received an email!')
+        database.mark_as_notified(event)
+        sent += 1
+    save_db(database)
+    return sent
+
+
+def main(connections: int = 4, login_timeout: float = 5 * 60):
+    # Setting the database as global so it can be called upon within the python interactive mode.
+    global database
+
+    # Every service logs in at the same time in the background, this also waits for an
+    # internet connection since logging in is retried until it works.
+    sessions = SessionManager()
+    gmail_retriever, gmail_sender, zoom, calendar = connect_services(sessions)
+
+    # Opens the database / create new one if none exists.
+    database = open_db()
+    # Cleans up database to save disk space. Commenting this out will not affect the program.
+    print(database.check_for_cleanup(), 'Old Events Cleared.')
+
+    # Only Gmail is needed to start, zoom and the calendar finish logging in while emails download.
+    sessions.require(['gmail'], login_timeout)
+
+    # Remembers the last email seen in each label so only new emails are downloaded.
+    sync_state = SyncState()
+    # Schedules up to 4 events at the same time, writing down each step in case of a crash.
+    pipeline = IngestPipeline(database, zoom, calendar, gmail_sender, Journal())
+    # Anything a crashed run left half done is finished first.
+    pipeline.replay()
+
+    # Emails parsed in an earlier run are looked up instead of being downloaded again.
+    # Thousands of new emails, as on first setup, are downloaded over several connections at once.
+    schedule_new_mail(database, gmail_retriever, pipeline, sync_state, ParseCache(), connections)
+    send_confirmations(database, gmail_sender)
+    # Texts sent to every carrier's gateway learn which one worked from the bounces.
+    learn_carriers(gmail_retriever, gmail_sender.carriers, SyncState('carrier_sync.json'))
+    gmail_sender.close()
+    sessions.stop()
+    metrics.publish()
+
+
+def daemon(idle_timeout: float = 25 * 60, housekeeping: float = 60 * 60, max_backoff: float = 5 * 60,
+           login_timeout: float = 5 * 60):
+    """
+    This function keeps running and schedules new Calendly emails as soon as they arrive. It
+    keeps the Gmail connection open and waits with IMAP IDLE instead of searching the label
+    over and over. Cleaning up the database, finishing the events the journal has half done and
+    sending confirmation emails happens every 'housekeeping' seconds. If the connection drops
+    it reconnects, waiting longer after every failed attempt up to 'max_backoff' seconds. It
+    gives up if Gmail can not be logged into within 'login_timeout' seconds of starting.
+    :param idle_timeout:
+    :param housekeeping:
+    :param max_backoff:
+    :param login_timeout:
+    :return:
+    """
+    global database
+
+    sessions = SessionManager()
+    gmail_retriever, gmail_sender, zoom, calendar = connect_services(sessions)
+    database = open_db()
+    sessions.require(['gmail'], login_timeout)
+    sync_state = SyncState()
+    pipeline = IngestPipeline(database, zoom, calendar, gmail_sender, Journal())
+    pipeline.replay()
+    cache = ParseCache()
+    next_housekeeping = monotonic()
+    new_mail = True
+    backoff = 1
+
+    try:
+        while True:
+            try:
+                if new_mail:
+                    if schedule_new_mail(database, gmail_retriever, pipeline, sync_state, cache):
+                        send_confirmations(database, gmail_sender)
+                if monotonic() >= next_housekeeping:
+                    print(database.check_for_cleanup(), 'Old Events Cleared.')
+                    # Events the journal still has half done are tried again instead of waiting for a restart.
+                    if pipeline.replay():
+                        save_db(database)
+                    send_confirmations(database, gmail_sender)
+                    learn_carriers(gmail_retriever, gmail_sender.carriers, SyncState('carrier_sync.json'))
+                    next_housekeeping = monotonic() + housekeeping
+                    # Reading the carriers leaves the label, so anything that arrived meanwhile was
+                    # never announced to idle and the label is searched again right away.
+                    new_mail = True
+                    continue
+                metrics.publish()
+                new_mail = gmail_retriever.idle(min(idle_timeout, max(1, next_housekeeping - monotonic())))
+                backoff = 1
+            except (imaplib.IMAP4.abort, imaplib.IMAP4.error, OSError) as e:
+                print(f'Lost the connection to Gmail ({e!r}), reconnecting in {backoff} seconds.')
+                # The emails read before it dropped may not have been scheduled, so only what was
+                # saved counts.
+                sync_state.load()
+                sleep(backoff)
+                backoff = min(backoff * 2, max_backoff)
+                try:
+                    gmail_retriever.reconnect()
+                    # Anything that arrived while disconnected is picked up right away.
+                    new_mail = True
+                except (imaplib.IMAP4.error, OSError) as e:
+                    print(f'Could not reconnect to Gmail: {e!r}')
+                    new_mail = False
+    except KeyboardInterrupt:
+        print('Stopping.')
+    finally:
+        gmail_sender.close()
+        sessions.stop()
+        metrics.publish()
+
+
+def connect_tutor(tutor: dict, shared: dict) -> tuple:
+    """
+    This function logs into the services of one tutor from their entry in the tutors file
+    and returns (gmail retriever, gmail sender, zoom, calendar). Every tutor uses the same
+    pool of connections to zoom and tutors on the same zoom account share its rate limit.
+    :param tutor:
+    :param shared:
+    :return:
+    """
+    gmail = tutor['gmail']
+    gmail_retriever = Gmail(gmail['username'], gmail['password'], gmail.get('imap', 'imap.gmail.com'),
+                            gmail.get('imap_port', 993), ssl=gmail.get('ssl', True))
+    gmail_sender = Alert(gmail['username'], gmail['password'], gmail.get('smtp', 'smtp.gmail.com'),
+                         gmail.get('smtp_port', 465), workers=1, ssl=gmail.get('ssl', True),
+                         carriers_file=os.path.join(tutor['folder'], 'carriers.json'))
+    with shared['lock']:
+        if tutor['zoom']['key'] not in shared['limiters']:
+            shared['limiters'][tutor['zoom']['key']] = RateLimiter(shared['zoom_rate'])
+        limiter = shared['limiters'][tutor['zoom']['key']]
+    zoom = Zoom(tutor['zoom']['key'], tutor['zoom']['secret'], api=tutor['zoom'].get('api', 'https://api.zoom.us/v2'),
+                limiter=limiter, session=shared['session'])
+    calendar = Calendar(tutor['calendar'], user_file=os.path.join(tutor['folder'], 'calendar_auth.json'),
+                        discovery_file=os.path.join(tutor['folder'], 'calendar_discovery.json'))
+    gmail_retriever.set_label(tutor.get('label', 'Tutoring'))
+    return gmail_retriever, gmail_sender, zoom, calendar
+
+
+def run_tutor(tutor: dict, shared: dict) -> int:
+    """
+    This function does what main does for one tutor, everything it saves is kept in the
+    tutor's own folder. It returns how many events were added.
+    :param tutor:
+    :param shared:
+    :return:
+    """
+    os.makedirs(tutor['folder'], exist_ok=True)
+    gmail_retriever, gmail_sender, zoom, calendar = connect_tutor(tutor, shared)
+    database = open_db(os.path.join(tutor['folder'], 'tutoring.sqlite3'),
+                       os.path.join(tutor['folder'], 'tutoring.database'))
+    try:
+        database.check_for_cleanup()
+        pipeline = IngestPipeline(database, zoom, calendar, gmail_sender,
+                                  Journal(os.path.join(tutor['folder'], 'tutoring.journal')))
+        pipeline.replay()
+        added = schedule_new_mail(database, gmail_retriever, pipeline,
+                                  SyncState(os.path.join(tutor['folder'], 'gmail_sync.json')),
+                                  ParseCache(os.path.join(tutor['folder'], 'parse_cache.json')),
+                                  tutor['gmail'].get('connections', 4))
+        send_confirmations(database, gmail_sender)
+        learn_carriers(gmail_retriever, gmail_sender.carriers,
+                       SyncState(os.path.join(tutor['folder'], 'carrier_sync.json')))
+        return added
+    finally:
+        gmail_sender.close()
+        database.close()
+        try:
+            gmail_retriever.connection.logout()
+        except Exception:
+            pass
+
+
+def run_tutors(file: str = 'tutors.json') -> dict:
+    """
+    This function runs the core script for every tutor listed in the tutors file, a few at
+    the same time, and returns how many events each one added or the error that stopped it.
+    One tutor failing does not stop the others. The file looks like this, only 'tutors' is
+    needed and each tutor's files go in tutors/<name> unless a folder is given. The gmail entry
+    can also set 'imap', 'imap_port', 'smtp', 'smtp_port' and 'ssl' for other mail servers and
+    'connections' for how many IMAP connections a backfill uses:
+    {"max_concurrent": 4, "zoom_rate": 10,
+     "tutors": [{"name": "alex", "label": "Tutoring", "calendar": "ALEX@gmail.com", "folder": "tutors/alex",
+                 "gmail": {"username": "ALEX@gmail.com", "password": "APP PASSWORD"},
+                 "zoom": {"key": "ZOOM KEY", "secret": "ZOOM SECRET"}}]}
+    :param file:
+    :return:
+    """
+    import requests
+    with open(file, 'r') as f:
+        config = json.load(f)
+    max_concurrent = config.get('max_concurrent', 4)
+
+    # One session for every tutor keeps a single pool of open connections to zoom, sized for
+    # every pipeline worker of every tutor running at the same time.
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max_concurrent * 4))
+    shared = {'lock': threading.Lock(), 'limiters': {}, 'zoom_rate': config.get('zoom_rate', 10), 'session': session}
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        running = {}
+        for tutor in config['tutors']:
+            tutor.setdefault('folder', os.path.join('tutors', tutor['name']))
+            running[tutor['name']] = executor.submit(run_tutor, tutor, shared)
+        for name, future in running.items():
+            try:
+                results[name] = future.result()
+                print(f'{name}: {results[name]} events added.')
+            except Exception as e:
+                results[name] = e
+                print(f'{name} could not be run: {e!r}')
+    session.close()
+    metrics.publish()
+    return results
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Schedules tutoring sessions booked through Calendly.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running and schedule new bookings as soon as their email arrives.')
+    parser.add_argument('--metrics', nargs='?', const='tutoring_metrics.json', metavar='FILE',
+                        help='Time each stage and write a JSON summary (tutoring_metrics.json by default).')
+    parser.add_argument('--prometheus', metavar='FILE',
+                        help='Also write the metrics in the prometheus text format, updated as the daemon runs.')
+    parser.add_argument('--tutors', metavar='FILE',
+                        help='Run once for every tutor listed in this file instead, see run_tutors.')
+    parser.add_argument('--connections', type=int, default=4,
+                        help='IMAP connections used to download thousands of new emails, such as on first setup.')
+    args = parser.parse_args()
+    if args.metrics or args.prometheus:
+        metrics.enable(args.metrics, args.prometheus)
+    if args.tutors:
+        run_tutors(args.tutors)
+    elif args.daemon:
+        daemon()
+    else:
+        main(args.connections)